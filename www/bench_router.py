@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+动态路由查找的基准测试：按顺序逐个正则match 与 前缀树_Router 的对比
+python bench_router.py
+"""
+
+import timeit
+
+from transwarp.web import Route, _Router
+
+def make_routes(n):
+	"""生成n个动态路由，包括整段变量、多个变量和段内混合变量三种"""
+	L = []
+	for i in range(n):
+		for path in ('/api/res%d/:id' % i, '/api/res%d/:id/comments/:cid' % i, '/feed%d/:name.json' % i):
+			def handler(*args):
+				return args
+			handler.__web_route__ = path
+			handler.__web_method__ = 'GET'
+			L.append(Route(handler))
+	return L
+
+def linear_match(routes, path):
+	for route in routes:
+		args = route.match(path)
+		if args:
+			return route, args
+	return None, None
+
+def bench(n, number=2000):
+	routes = make_routes(n)
+	router = _Router(routes)
+	paths = {
+		'first': '/api/res0/123',
+		'last': '/feed%d/abc.json' % (n - 1),
+		'nested': '/api/res%d/1/comments/2' % (n // 2),
+		'404': '/api/missing/123',
+	}
+	for name, path in sorted(paths.items()):
+		assert linear_match(routes, path) == router.match(path), path
+		linear = timeit.timeit(lambda: linear_match(routes, path), number=number) / number * 1e6
+		tree = timeit.timeit(lambda: router.match(path), number=number) / number * 1e6
+		print '%6d routes  %-7s linear %10.2f us   router %6.2f us' % (len(routes), name, linear, tree)
+
+if __name__ == '__main__':
+	for n in (10, 100, 400, 2000):
+		bench(n, number=200 if n > 100 else 2000)
@@ -6,7 +6,7 @@ import config_default
 import logging
 
 def merge(defaults, override):
-	"""合并默认的和覆盖的参数"""
+	"""合并默认的和覆盖的参数，只在覆盖的参数中出现的key（如分片名）也保留"""
 	r = {}
 	for k,v in defaults.iteritems():
 		if k in override:
@@ -16,6 +16,9 @@ def merge(defaults, override):
 				r[k] = override[k]
 		else:
 			r[k] = v
+	for k,v in override.iteritems():
+		if k not in defaults:
+			r[k] = v
 	return r
 
 def toDict(d):
@@ -2,11 +2,16 @@
 
 configs = {
 	'db':{
+	     #'mysql'或'sqlite'，sqlite时database为文件路径或':memory:'
+	     'dialect': 'mysql',
 	     'host': '127.0.0.1',
 	     'user': 'root',
 	     'password': '',
 	     'port': 3306,
-	     'database': 'awesome'
+	     'database': 'awesome',
+	     #分片名 => 覆盖以上参数的dict，如 {'shard0': {'database': 'awesome_0'}, 'shard1': {'database': 'awesome_1'}}
+	     #为空时不分片，Blog和Comment按主键分布在所有分片上
+	     'shards': {}
 	},
 	'session':{
 	     'secret': 'AwEsOmE'
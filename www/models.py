@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import uuid
 import time
-from transwarp.db import next_id
+from transwarp.db import next_id, hash_shard
 from transwarp.orm import Model,StringField,IntegerField,BooleanField,FloatField,TextField
 
 class User(Model):
@@ -17,6 +17,7 @@ class User(Model):
     created_at = FloatField(updatable=False, default=time.time
 	"""
 	__table__ = 'user'
+	__cache__ = dict(ttl=60, maxsize=10000)
 	id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
 	email = StringField(updatable=False, ddl ='varchar(50)')
 	password = StringField(ddl = 'varchar(50)')	
@@ -32,17 +33,20 @@ class Blog(Model):
 	"""
 
 	__table__ = 'blog'
+	__cache__ = dict(ttl=60, maxsize=10000)
+	__shard__ = hash_shard
 	id = StringField(primary_key=True, default = next_id, ddl = 'varchar(50)')
 	user_id = StringField(updatable=False, ddl='varchar(50)')
 	user_name = StringField(ddl = 'varchar(50)')
 	user_image = StringField(ddl = 'varchar(500)')
 	title = StringField(ddl = 'varchar(50)')
 	summary = StringField(ddl = 'varchar(500)')
-	content = TextField()
+	content = TextField(lazy=True)
 	created_at = FloatField(updatable=False, default=time.time)
 
 class Comment(Model):
 	__table__ = 'comment'
+	__shard__ = hash_shard
 	id = StringField(primary_key=True, default=next_id, ddl = 'varchar(50)')
 	blog_id = StringField(updatable=False, ddl = 'varchar(50)')
 	user_id = StringField(updatable=False, ddl = 'varchar(50)')
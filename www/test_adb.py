@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+transwarp.adb的测试，使用sqlite，不需要数据库服务
+python3 test_adb.py
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+
+from transwarp import adb
+
+logging.basicConfig(level = logging.ERROR)
+
+async def main():
+	await adb.update('create table user (id text primary key, name text, admin bool)')
+
+	await adb.insert('user', id='1', name='Michael', admin=True)
+	await adb.update_many('insert into user (id, name, admin) values (?, ?, ?)', [('2', 'Bob', False), ('3', 'Alice', False)])
+	assert await adb.select_int('select count(*) from user') == 3
+	u = await adb.selectone('select * from user where id=?', '1')
+	assert u.name == 'Michael'
+	assert [x.name for x in await adb.select('select * from user where admin=? order by id', False)] == ['Bob', 'Alice']
+	assert await adb.selectone('select * from user where id=?', 'none') is None
+
+	#异常时回滚整个事务，嵌套的事务加入外层事务
+	try:
+		async with adb.transaction():
+			await adb.update('update user set name=? where id=?', 'changed', '1')
+			async with adb.transaction():
+				await adb.update('delete from user where id=?', '2')
+			raise RuntimeError('rollback')
+	except RuntimeError:
+		pass
+	assert (await adb.selectone('select name from user where id=?', '1')).name == 'Michael'
+	assert await adb.select_int('select count(*) from user') == 3
+
+	async with adb.transaction():
+		await adb.update('update user set name=? where id=?', 'Tom', '2')
+	assert (await adb.selectone('select name from user where id=?', '2')).name == 'Tom'
+
+	#并发的task各自使用连接池中的连接，连接数不超过pool_max_size
+	async def worker(i):
+		async with adb.connection():
+			await adb.insert('user', id='w%d' % i, name='worker', admin=False)
+			await asyncio.sleep(0.01)
+			return await adb.select_int('select count(*) from user where id=?', 'w%d' % i)
+	assert await asyncio.gather(*[worker(i) for i in range(20)]) == [1] * 20
+	assert adb.engine.pool.size <= 4
+	assert await adb.select_int('select count(*) from user where name=?', 'worker') == 20
+
+	await adb.engine.close()
+
+if __name__ == '__main__':
+	path = os.path.join(tempfile.mkdtemp(), 'test_adb.db')
+	adb.create_engine(database=path, dialect='sqlite', pool_max_size=4)
+	asyncio.run(main())
+	adb.engine = None
+
+	#内存数据库只有一个连接，并发的task依次使用
+	adb.create_engine(database=':memory:', dialect='sqlite', pool_max_size=4)
+	asyncio.run(main())
+	print('ok')
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+transwarp.orm的测试，使用sqlite，不需要数据库服务
+python test_orm.py
+"""
+
+import logging
+import os
+import tempfile
+
+from models import User, Blog
+
+from transwarp import db
+
+logging.basicConfig(level = logging.ERROR)
+
+db.create_engine(database=os.path.join(tempfile.mkdtemp(), 'test_orm.db'), dialect='sqlite')
+db.update(User.__sql__())
+db.update(Blog.__sql__())
+
+u = User(name='Michael', email='test@example.com', password='1234567890', image='about:blank')
+u.insert()
+b = Blog(user_id=u.id, user_name=u.name, user_image=u.image, title='Test', summary='summary', content='old')
+b.insert()
+
+#lazy字段没有载入，赋值后update要写入该字段
+b1 = Blog.find_first('where id=?', b.id)
+assert 'content' not in b1
+b1.content = 'NEW'
+b1.update()
+assert db.select_int('select count(*) from blog where content=?', 'NEW') == 1
+
+b2 = Blog.get(b.id)
+b2.content = 'NEW2'
+b2.update()
+assert Blog.find_first('where id=?', b.id).content == 'NEW2'
+
+#投影外的字段同样处理
+b3 = Blog.query().only('id', 'title').filter(id=b.id).first()
+b3.summary = 'changed'
+b3.update()
+b4 = Blog.find_first('where id=?', b.id)
+assert (b4.title, b4.summary, b4.content) == ('Test', 'changed', 'NEW2')
+
+#只修改已载入的字段时，没有载入的字段保持不变
+b5 = Blog.find_first('where id=?', b.id)
+b5.title = 'Title'
+b5.update()
+assert db.select_int('select count(*) from blog where title=? and content=?', 'Title', 'NEW2') == 1
+
+print 'ok'
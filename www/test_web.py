@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+transwarp.web中multipart/form-data解析的测试
+python test_web.py
+"""
+
+from StringIO import StringIO
+
+from transwarp.web import Request, MultiPartFile
+
+_BOUNDARY = '----transwarp-test'
+
+def _multipart(fields):
+	"""fields为 (name, filename, value) 的列表，filename为None时是普通字段"""
+	L = []
+	for name, filename, value in fields:
+		L.append('--%s\r\n' % _BOUNDARY)
+		if filename is None:
+			L.append('Content-Disposition: form-data; name="%s"\r\n\r\n' % name)
+		else:
+			L.append('Content-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: application/octet-stream\r\n\r\n' % (name, filename))
+		L.append(value)
+		L.append('\r\n')
+	L.append('--%s--\r\n' % _BOUNDARY)
+	return ''.join(L)
+
+def _request(fields):
+	body = _multipart(fields)
+	return Request({
+		'REQUEST_METHOD': 'POST',
+		'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % _BOUNDARY,
+		'CONTENT_LENGTH': str(len(body)),
+		'wsgi.input': StringIO(body),
+	})
+
+#字段跨过64KB一次读取的边界：第二个字段在缓冲区重新填充时被截断过
+fields = [
+	('a', None, 'a' * 65400),
+	('b', None, 'b' * 1000),
+	('c', None, 'c' * 200 * 1024),
+	('f', 'f.bin', ''.join([chr(i % 256) for i in range(150 * 1024)])),
+	('d', None, 'd' * 65536),
+	('e', None, ''),
+]
+
+#stream_input()中读完上传的文件再取下一个字段
+L = []
+for name, value in _request(fields).stream_input():
+	if isinstance(value, MultiPartFile):
+		value = value.file.read()
+	L.append((name, value))
+assert [(name, len(value)) for name, value in L] == [(name, len(value)) for name, filename, value in fields]
+assert L == [(name, value) for name, filename, value in fields]
+
+#input()中上传的文件保存为临时文件
+i = _request(fields).input()
+for name, filename, value in fields:
+	if filename is None:
+		assert i[name] == value, name
+	else:
+		assert i[name].filename == filename
+		assert i[name].file.read() == value
+
+print 'ok'
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+db模块的asyncio版本，接口与db保持一致，所有数据库操作都需要await
+
+	adb.create_engine(user='www-data', password='www-data', database='awesome')
+	async with adb.transaction():
+		await adb.update('update user set name=? where id=?', name, pk)
+	users = await adb.select('select * from user where admin=?', True)
+
+与db的区别：
+	1. 连接状态保存在contextvars中而不是threading.local，每个asyncio task有自己的连接上下文，
+	   在连接上下文中创建的task不会共用该上下文的连接，而是使用自己的连接
+	2. 连接池用asyncio.Condition等待归还的连接，等待时不占用线程
+	3. 驱动需要提供aiomysql风格的接口：connect、cursor、execute、fetch*、commit、rollback都是协程，
+	   缺省使用aiomysql；dialect='sqlite'时使用标准库的sqlite3，阻塞的调用放到线程池中执行，
+	   不需要数据库服务，可以用于测试：
+		adb.create_engine(database='/tmp/test.db', dialect='sqlite')
+
+本模块需要Python 3.7以上，db和orm不会导入它
+orm的Model只能在Python 2中使用，本模块只提供sql层的接口
+"""
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import time
+import uuid
+
+engine = None
+
+def next_id(t=None):
+	"""生成一个唯一id，与db.next_id相同"""
+	if t is None:
+		t = time.time()
+	return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
+
+def create_engine(user=None, password=None, database=None, host='127.0.0.1', port=3306, **kw):
+	"""
+	创建全局的异步引擎，参数与db.create_engine相同
+	dialect='mysql'（缺省）使用aiomysql
+	dialect='sqlite'使用标准库的sqlite3，database为文件路径或':memory:'，忽略user/password/host/port，
+	sqlite_timeout为等待写锁的秒数，':memory:'只使用一个连接
+	连接池参数：pool_min_size, pool_max_size, pool_idle_timeout, pool_timeout, pool_ping_interval
+	"""
+	global engine
+	if engine is not None:
+		raise DBError('engine has already initialized')
+	dialect = kw.pop('dialect', 'mysql')
+	pool_params = dict(min_size=0, max_size=10, idle_timeout=300, timeout=30, ping_interval=0)
+	for k, v in pool_params.items():
+		pool_params[k] = kw.pop('pool_%s' % k, v)
+	if dialect == 'mysql':
+		import aiomysql
+		params = dict(user=user, password=password, db=database, host=host, port=port)
+		defaults = dict(use_unicode=True, charset='utf8', autocommit=False)
+		for k, v in defaults.items():
+			params[k] = kw.pop(k, v)
+		params.update(kw)
+		engine = _Engine(functools.partial(aiomysql.connect, **params), **pool_params)
+	elif dialect == 'sqlite':
+		database = database or ':memory:'
+		params = dict(timeout=kw.pop('sqlite_timeout', 5))
+		if database == ':memory:':
+			#每个连接是一个独立的内存数据库，只用一个常驻的连接，其他task等待该连接归还（不占用线程）
+			#需要多个连接并发写入时使用文件数据库
+			pool_params.update(min_size=1, max_size=1, idle_timeout=0)
+		params.update(kw)
+		engine = _Engine(functools.partial(_sqlite_connect, database, **params), placeholder='?', **pool_params)
+	else:
+		raise DBError('unsupported dialect: %s' % dialect)
+
+async def _run(func, *args):
+	"""在线程池中执行阻塞的调用"""
+	return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args))
+
+class _SqliteCursor(object):
+	"""sqlite3的cursor，提供aiomysql风格的协程接口"""
+	def __init__(self, cursor):
+		self._cursor = cursor
+
+	@property
+	def description(self):
+		return self._cursor.description
+
+	@property
+	def rowcount(self):
+		return self._cursor.rowcount
+
+	async def execute(self, sql, args=()):
+		await _run(self._cursor.execute, sql, args)
+
+	async def executemany(self, sql, args_list):
+		await _run(self._cursor.executemany, sql, args_list)
+
+	async def fetchone(self):
+		return await _run(self._cursor.fetchone)
+
+	async def fetchall(self):
+		return await _run(self._cursor.fetchall)
+
+	def close(self):
+		self._cursor.close()
+
+class _SqliteConnection(object):
+	"""sqlite3的连接，提供aiomysql风格的协程接口，同一时间只被一个连接上下文使用"""
+	def __init__(self, conn):
+		self._conn = conn
+
+	def cursor(self):
+		return _SqliteCursor(self._conn.cursor())
+
+	async def commit(self):
+		await _run(self._conn.commit)
+
+	async def rollback(self):
+		await _run(self._conn.rollback)
+
+	def close(self):
+		self._conn.close()
+
+async def _sqlite_connect(database, **kw):
+	"""打开sqlite连接，连接会在线程池的不同线程中使用，关闭同线程检查"""
+	import sqlite3
+	conn = await _run(functools.partial(sqlite3.connect, database, check_same_thread=False, **kw))
+	return _SqliteConnection(conn)
+
+async def _maybe_await(r):
+	"""驱动的close等方法有的是协程，有的是普通函数"""
+	if inspect.isawaitable(r):
+		return await r
+	return r
+
+async def _close_quietly(conn):
+	try:
+		await _maybe_await(conn.close())
+	except Exception:
+		logging.exception('close connection failed.')
+
+class Dict(dict):
+	"""可以通过属性访问的字典，与db.Dict相同"""
+	def __init__(self, names=(), values=(), **kw):
+		super(Dict, self).__init__(**kw)
+		for k, v in zip(names, values):
+			self[k] = v
+
+	def __getattr__(self, key):
+		try:
+			return self[key]
+		except KeyError:
+			raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+
+	def __setattr__(self, key, value):
+		self[key] = value
+
+class _ConnectionPool(object):
+	"""
+	asyncio有界连接池，参数与db._ConnectionPool相同
+	connect: 返回连接的协程函数
+	"""
+	def __init__(self, connect, min_size=0, max_size=10, idle_timeout=300, timeout=30, ping_interval=0):
+		if max_size < 1 or min_size > max_size:
+			raise DBError('invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
+		self._connect = connect
+		self.min_size = min_size
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+		self.ping_interval = ping_interval
+		#Condition在第一次使用时创建，绑定当时运行的事件循环
+		self._cond = None
+		#空闲连接栈：(connection, 归还时间)，后进先出
+		self._idle = []
+		self._size = 0
+
+	@property
+	def size(self):
+		return self._size
+
+	@property
+	def idle(self):
+		return len(self._idle)
+
+	@property
+	def in_use(self):
+		return self._size - len(self._idle)
+
+	def _condition(self):
+		if self._cond is None:
+			self._cond = asyncio.Condition()
+		return self._cond
+
+	def _evict_idle(self, now):
+		"""移出空闲过久的连接，返回需要关闭的连接"""
+		if not self.idle_timeout:
+			return []
+		expired = []
+		keep = []
+		for conn, last_used in self._idle:
+			if now - last_used > self.idle_timeout and self._size - len(expired) > self.min_size:
+				expired.append(conn)
+			else:
+				keep.append((conn, last_used))
+		self._idle = keep
+		self._size -= len(expired)
+		return expired
+
+	async def _is_alive(self, conn):
+		ping = getattr(conn, 'ping', None)
+		if ping is None:
+			return True
+		try:
+			await _maybe_await(ping(False))
+			return True
+		except Exception:
+			return False
+
+	async def acquire(self):
+		"""取出一个连接，池满时等待，超时抛出PoolTimeoutError"""
+		loop = asyncio.get_event_loop()
+		deadline = loop.time() + self.timeout if self.timeout is not None else None
+		cond = self._condition()
+		while True:
+			conn = last_used = None
+			async with cond:
+				expired = self._evict_idle(time.time())
+				while not self._idle and self._size >= self.max_size:
+					remaining = None if deadline is None else deadline - loop.time()
+					if remaining is not None and remaining <= 0:
+						raise PoolTimeoutError('no connection available in %s seconds' % self.timeout)
+					try:
+						await asyncio.wait_for(cond.wait(), remaining)
+					except asyncio.TimeoutError:
+						pass
+				if self._idle:
+					conn, last_used = self._idle.pop()
+				else:
+					self._size += 1
+			for c in expired:
+				await _close_quietly(c)
+			if conn is None:
+				logging.info('open new connection <%s>...' % self._size)
+				try:
+					return await self._connect()
+				except BaseException:
+					await self._discard(None)
+					raise
+			if time.time() - last_used < self.ping_interval or await self._is_alive(conn):
+				return conn
+			logging.warning('discard broken connection.')
+			await self._discard(conn)
+
+	async def release(self, conn):
+		"""归还连接，回滚未提交的隐式事务，失败则丢弃该连接"""
+		try:
+			await conn.rollback()
+		except Exception:
+			logging.warning('reset connection failed, discard it.')
+			await self._discard(conn)
+			return
+		cond = self._condition()
+		async with cond:
+			self._idle.append((conn, time.time()))
+			cond.notify()
+
+	async def _discard(self, conn):
+		cond = self._condition()
+		async with cond:
+			self._size -= 1
+			cond.notify()
+		if conn is not None:
+			await _close_quietly(conn)
+
+	async def close(self):
+		"""关闭所有空闲连接"""
+		idle = self._idle
+		self._idle = []
+		self._size -= len(idle)
+		for conn, last_used in idle:
+			await _close_quietly(conn)
+
+class _Engine(object):
+	"""
+	异步数据库引擎
+	connect: 返回连接的协程函数
+	placeholder: 驱动的参数占位符，aiomysql为%s，sqlite类驱动为?（此时sql不做替换）
+	"""
+	def __init__(self, connect, placeholder='%s', **pool_kw):
+		self.placeholder = placeholder
+		self.pool = _ConnectionPool(connect, **pool_kw)
+
+	def statement(self, sql):
+		"""把?风格的sql改写为驱动的占位符"""
+		if self.placeholder == '?':
+			return sql
+		return sql.replace('?', self.placeholder)
+
+	async def close(self):
+		await self.pool.close()
+
+class _LazyConnection(object):
+	"""惰性连接对象，第一次使用时从连接池取出连接"""
+	def __init__(self):
+		self.connection = None
+
+	async def cursor(self):
+		if self.connection is None:
+			self.connection = await engine.pool.acquire()
+		return await _maybe_await(self.connection.cursor())
+
+	async def commit(self):
+		if self.connection is not None:
+			await self.connection.commit()
+
+	async def rollback(self):
+		if self.connection is not None:
+			await self.connection.rollback()
+
+	async def cleanup(self):
+		if self.connection is not None:
+			_connection = self.connection
+			self.connection = None
+			await engine.pool.release(_connection)
+
+class _DbCtx(object):
+	"""一个task的连接上下文：连接、事务层数，保存在_ctx中"""
+	def __init__(self):
+		self.connection = _LazyConnection()
+		self.transaction = 0
+		self.task = asyncio.current_task()
+
+_ctx = contextvars.ContextVar('transwarp.adb', default=None)
+
+def _current():
+	"""返回当前task的连接上下文，没有时返回None（子task继承的父task上下文不算）"""
+	ctx = _ctx.get()
+	if ctx is not None and ctx.task is asyncio.current_task():
+		return ctx
+	return None
+
+class _ConnectionCtx(object):
+	"""连接上下文，async with块内的所有adb调用复用同一个惰性连接"""
+	async def __aenter__(self):
+		self.token = None
+		if _current() is None:
+			self.token = _ctx.set(_DbCtx())
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, exc_traceback):
+		if self.token is not None:
+			ctx = _ctx.get()
+			_ctx.reset(self.token)
+			await ctx.connection.cleanup()
+
+class _TransactionCtx(object):
+	"""可以嵌套的事务，最外层结束时提交，出现异常时回滚"""
+	async def __aenter__(self):
+		self.conn_ctx = _ConnectionCtx()
+		await self.conn_ctx.__aenter__()
+		self.ctx = _current()
+		self.ctx.transaction += 1
+		logging.info('begin transaction ...' if self.ctx.transaction == 1 else 'join current transaction...')
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, exc_traceback):
+		ctx = self.ctx
+		ctx.transaction -= 1
+		try:
+			if ctx.transaction == 0:
+				if exc_type is None:
+					await self.commit()
+				else:
+					await self.rollback()
+		finally:
+			await self.conn_ctx.__aexit__(exc_type, exc_value, exc_traceback)
+
+	async def commit(self):
+		logging.info('commit transaction...')
+		try:
+			await self.ctx.connection.commit()
+			logging.info('commit OK')
+		except BaseException:
+			logging.warning('commit failed.try rollback...')
+			await self.ctx.connection.rollback()
+			raise
+
+	async def rollback(self):
+		logging.warning('rollback transaction...')
+		await self.ctx.connection.rollback()
+		logging.warning('rollback OK ......')
+
+def connection():
+	"""
+	返回一个连接上下文，用于async with语句
+	async with adb.connection():
+		await adb.select(...)
+		await adb.update(...)
+	"""
+	return _ConnectionCtx()
+
+def transaction():
+	"""
+	返回一个事务上下文，用于async with语句，可以嵌套
+	async with adb.transaction():
+		await adb.insert(...)
+		await adb.update(...)
+	"""
+	return _TransactionCtx()
+
+def with_connection(func):
+	@functools.wraps(func)
+	async def _wrapper(*args, **kw):
+		async with _ConnectionCtx():
+			return await func(*args, **kw)
+	return _wrapper
+
+def with_transaction(func):
+	@functools.wraps(func)
+	async def _wrapper(*args, **kw):
+		async with _TransactionCtx():
+			return await func(*args, **kw)
+	return _wrapper
+
+@with_connection
+async def _select(sql, first, *args):
+	stmt = engine.statement(sql)
+	logging.info('SQL: %s, ARGS: %s' % (stmt, args))
+	cursor = await _current().connection.cursor()
+	try:
+		await cursor.execute(stmt, args)
+		names = [x[0] for x in cursor.description] if cursor.description else []
+		if first:
+			values = await cursor.fetchone()
+			return Dict(names, values) if values else None
+		return [Dict(names, x) for x in await cursor.fetchall()]
+	finally:
+		await _maybe_await(cursor.close())
+
+async def selectone(sql, *args):
+	"""执行sql，返回第一条结果，无结果时返回None"""
+	return await _select(sql, True, *args)
+
+async def select(sql, *args):
+	"""执行sql，返回结果列表"""
+	return await _select(sql, False, *args)
+
+async def select_int(sql, *args):
+	"""执行sql，返回第一行第一列的整数值"""
+	d = await _select(sql, True, *args)
+	return int(list(d.values())[0]) if d else 0
+
+@with_connection
+async def _update(sql, *args, **kw):
+	ctx = _current()
+	stmt = engine.statement(sql)
+	logging.warning('SQL: %s, ARGS: %s' % (stmt, kw.get('log', args)))
+	cursor = await ctx.connection.cursor()
+	try:
+		if kw.get('many'):
+			await cursor.executemany(stmt, args)
+		else:
+			await cursor.execute(stmt, args)
+		r = cursor.rowcount
+		if ctx.transaction == 0:
+			logging.info('auto commit')
+			await ctx.connection.commit()
+		return r
+	finally:
+		await _maybe_await(cursor.close())
+
+async def update(sql, *args):
+	"""执行update/insert/delete语句，返回影响的行数"""
+	return await _update(sql, *args)
+
+@with_transaction
+async def update_many(sql, args_list):
+	"""用executemany对每组参数执行同一条sql，所有行在一个事务中提交"""
+	args_list = list(args_list)
+	if not args_list:
+		return 0
+	return await _update(sql, *args_list, many=True, log='%d rows' % len(args_list))
+
+async def insert(table, **kw):
+	cols, args = zip(*kw.items())
+	sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+	return await _update(sql, *args)
+
+class DBError(Exception):
+	pass
+
+class PoolTimeoutError(DBError):
+	pass
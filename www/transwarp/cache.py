@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+进程内共享的缓存，用于orm中热点、很少修改的行
+Model通过 __cache__ = dict(ttl=60, maxsize=10000) 开启，
+也可以传入 backend=xxx 使用自定义的缓存后端
+"""
+
+import threading
+import time
+import collections
+
+from db import Dict
+
+class CacheBackend(object):
+	"""
+	缓存后端接口，自定义后端（如memcached）需要实现以下方法
+	value需要是不可变对象，orm中保存的是db.Row，可以用pickle序列化后保存到进程外
+	"""
+	def get(self, key):
+		"""返回缓存的值，不存在或已过期时返回None"""
+		raise NotImplementedError
+
+	def set(self, key, value, ttl=None):
+		raise NotImplementedError
+
+	def delete(self, key):
+		raise NotImplementedError
+
+	def clear(self):
+		raise NotImplementedError
+
+	def stats(self):
+		"""返回统计信息，至少包含hits, misses"""
+		return Dict()
+
+class LRUCache(CacheBackend):
+	"""
+	线程安全的内存LRU缓存
+	maxsize: 最多缓存的条目数，超出时淘汰最久未使用的条目，0表示不缓存
+	ttl: 缓存的秒数，None表示不过期
+	"""
+	def __init__(self, maxsize=10000, ttl=60):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._data = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def __len__(self):
+		return len(self._data)
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+			value, expires = entry
+			if expires is not None and expires < time.time():
+				self.expirations += 1
+				self.misses += 1
+				return None
+			self._data[key] = entry
+			self.hits += 1
+			return value
+
+	def set(self, key, value, ttl=None):
+		if ttl is None:
+			ttl = self.ttl
+		expires = time.time() + ttl if ttl is not None else None
+		with self._lock:
+			self._data.pop(key, None)
+			if self.maxsize <= 0:
+				return
+			while self._data and len(self._data) >= self.maxsize:
+				self._data.popitem(last=False)
+				self.evictions += 1
+			self._data[key] = (value, expires)
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def stats(self):
+		with self._lock:
+			return Dict(hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations, size=len(self._data))
+
+def create_backend(config):
+	"""根据Model的__cache__配置创建缓存后端"""
+	config = dict(config)
+	backend = config.pop('backend', None)
+	if backend is not None:
+		return backend
+	return LRUCache(**config)
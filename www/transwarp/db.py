@@ -1,12 +1,22 @@
 #!/usr/bin/env_python
 # -*- coding: utf-8 -*-
 import threading
+import re
+import sys
+import zlib
 import logging
 import functools 
 from contextlib import contextmanager
 import time,uuid
+import collections
+import operator
+import itertools
 
 engine = None
+#分片名 => 引擎，由create_engine的shards参数创建
+engines = {}
+#select默认返回的行类型，Dict或Row
+_row_type = None
 
 def next_id(t=None):
     """
@@ -17,18 +27,203 @@ def next_id(t=None):
     return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
     
-def create_engine(user,password,database,host='127.0.0.1',port=3306, **kw):
-	import mysql.connector
+def create_engine(user=None, password=None, database=None, host='127.0.0.1', port=3306, **kw):
+	"""
+	创建全局的数据库引擎
+	dialect='mysql'（缺省）使用mysql.connector
+	dialect='sqlite'使用标准库的sqlite3，database为文件路径或':memory:'，忽略user/password/host/port，
+	':memory:'的所有连接共用同一个共享缓存的内存数据库，同时只能有一个连接写入（其他连接写入时抛出database table is locked）：
+		sqlite_wal: 文件数据库是否开启WAL，缺省True
+		sqlite_pragmas: 覆盖缺省的pragma，如 dict(synchronous='FULL')
+		sqlite_timeout: 等待写锁的秒数
+	"""
 	global engine
 	if engine is not None:
 		raise DBError('engine has already initialized')
-	params = dict(user = user, password = password, database = database, host = host, port = port)
-	defaults = dict(use_unicode = True, charset = 'utf8', collation = 'utf8_general_ci', autocommit = False)
-	for k,v in defaults.iteritems():
-		params[k] = kw.pop(k,v)
+	dialect = kw.pop('dialect', 'mysql')
+	if dialect == 'mysql':
+		import mysql.connector
+		params = dict(user = user, password = password, database = database, host = host, port = port)
+		defaults = dict(use_unicode = True, charset = 'utf8', collation = 'utf8_general_ci', autocommit = False)
+		for k,v in defaults.iteritems():
+			params[k] = kw.pop(k,v)
+		connect_with = lambda params: functools.partial(mysql.connector.connect, **params)
+	elif dialect == 'sqlite':
+		params = dict(database = database or ':memory:')
+		for k in ('wal', 'pragmas', 'timeout'):
+			if 'sqlite_%s' % k in kw:
+				params[k] = kw.pop('sqlite_%s' % k)
+		connect_with = lambda params: functools.partial(_sqlite_connect, **params)
+	else:
+		raise DBError('unsupported dialect: %s' % dialect)
 	
+	pool_params = dict(min_size = 0, max_size = 10, idle_timeout = 300, timeout = 30, ping_interval = 30)
+	for k,v in pool_params.iteritems():
+		pool_params[k] = kw.pop('pool_%s' % k, v)
+	statement_cache_size = kw.pop('statement_cache_size', 64)
+	#从库列表，每个从库是覆盖主库参数的dict，如 [dict(host='10.0.0.2'), dict(host='10.0.0.3')]
+	replicas = kw.pop('replicas', None) or []
+	read_your_writes = kw.pop('read_your_writes', True)
+	#分片，分片名 => 覆盖主库参数的dict，如 {'shard0': dict(database='awesome_0'), 'shard1': dict(host='10.0.1.1')}
+	#分片的dict中也可以有自己的replicas
+	shards = kw.pop('shards', None) or {}
 	params.update(kw)
-	engine = _Engine(lambda:mysql.connector.connect(**params))
+
+	def _build(params, replicas):
+		engine_pool_params = pool_params
+		if dialect == 'sqlite' and params['database'] == ':memory:':
+			#连接池的连接打开同一个共享缓存的内存数据库，保留一个常驻的连接使数据库不被销毁
+			params = dict(params, database='file:transwarp_%s?mode=memory&cache=shared' % uuid.uuid4().hex)
+			engine_pool_params = dict(pool_params, min_size=max(1, pool_params['min_size']), idle_timeout=0)
+		replica_connects = []
+		for replica in replicas:
+			replica_params = dict(params)
+			replica_params.update(replica)
+			replica_connects.append(connect_with(replica_params))
+		return _Engine(connect_with(params), statement_cache_size, replicas=replica_connects, read_your_writes=read_your_writes, dialect=dialect, **engine_pool_params)
+
+	engine = _build(params, replicas)
+	for name, shard in shards.iteritems():
+		shard_params = dict(params)
+		shard_params.update(shard)
+		engines[name] = _build(shard_params, shard_params.pop('replicas', None) or [])
+
+#sqlite连接的缺省设置，内存数据库不使用journal_mode，并开启read_uncommitted
+_SQLITE_PRAGMAS = (
+	('journal_mode', 'WAL'),
+	#WAL模式下NORMAL不会损坏数据库，只可能丢失最后的事务
+	('synchronous', 'NORMAL'),
+	('foreign_keys', 'ON'),
+	('temp_store', 'MEMORY'),
+	#负数的单位是KB
+	('cache_size', '-16000'),
+	('mmap_size', '268435456'),
+)
+
+def _sqlite_connect(database, wal=True, pragmas=None, timeout=5, **kw):
+	"""打开sqlite连接并设置pragma，连接由连接池在线程间传递，关闭同线程检查"""
+	import sqlite3
+	conn = sqlite3.connect(database, timeout=timeout, check_same_thread=False, **kw)
+	memory = database == ':memory:' or (database.startswith('file:') and 'mode=memory' in database)
+	if memory and database != ':memory:' and conn.execute('pragma database_list').fetchone()[2]:
+		#sqlite没有开启URI文件名时会把uri当作文件名
+		conn.close()
+		raise DBError('sqlite %s does not support URI filenames, use a database file instead of :memory:' % sqlite3.sqlite_version)
+	settings = collections.OrderedDict(_SQLITE_PRAGMAS)
+	if not wal or memory:
+		del settings['journal_mode']
+	if memory:
+		#共享缓存中读操作不加表锁，遍历结果时其他连接仍可以写入
+		settings['read_uncommitted'] = 'true'
+	settings.update(pragmas or {})
+	for k, v in settings.iteritems():
+		conn.execute('pragma %s = %s' % (k, v))
+	return conn
+
+def dialect():
+	"""返回当前引擎的sql方言，'mysql'或'sqlite'，未创建引擎时为'mysql'"""
+	eng = _get_engine()
+	return eng.dialect if eng is not None else 'mysql'
+
+def shard_names():
+	"""返回所有分片名，没有配置分片时返回空列表"""
+	return sorted(engines)
+
+def hash_shard(pk):
+	"""
+	按主键的crc32在所有分片间分配，可作为Model的__shard__函数
+	没有配置分片时返回None，即使用缺省的引擎
+	"""
+	if not engines:
+		return None
+	names = shard_names()
+	return names[(zlib.crc32(str(pk)) & 0xffffffff) % len(names)]
+
+def use_engine(name):
+	"""
+	返回一个切换引擎的上下文，用于with语句，块内当前线程的db调用都在分片name上执行
+	name为None时不切换
+	with db.use_engine('shard0'):
+		db.select(...)
+	"""
+	return _EngineCtx(name)
+
+def current_shard():
+	"""返回当前线程所在的分片名，不在分片上下文中时返回None"""
+	return _dbCtx.shard
+
+def scatter(func, names=None):
+	"""
+	在每个分片上并行执行func()（每个分片一个线程），返回按分片名排列的结果列表
+	任何一个分片抛出异常时，等待所有分片结束后重新抛出第一个异常
+	func在新的线程中执行，使用分片上新的连接，不属于调用者的事务
+	"""
+	names = shard_names() if names is None else list(names)
+	if len(names) == 1:
+		with _EngineCtx(names[0]):
+			return [func()]
+	results = {}
+	errors = []
+	def _run(name):
+		try:
+			with _EngineCtx(name):
+				results[name] = func()
+		except Exception:
+			errors.append(sys.exc_info())
+	threads = [threading.Thread(target=_run, args=(name,)) for name in names]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	if errors:
+		exc_type, exc_value, exc_traceback = errors[0]
+		raise exc_type, exc_value, exc_traceback
+	return [results[name] for name in names]
+
+def set_row_type(row_type):
+	"""
+	设置select/selectone/iter_select默认返回的行类型
+	Dict: 可修改的字典行（默认）
+	Row: 每种列组合生成一次的紧凑只读行，内存更少，构造更快
+	"""
+	global _row_type
+	_row_type = row_type
+
+def statement_cache_stats():
+	"""返回预编译语句缓存的命中统计：hits, misses, evictions, statements"""
+	return engine.statement_stats()
+
+def connection(identity_map=False):
+	"""
+	返回一个连接上下文，用于with语句，块内的所有db调用复用同一个惰性连接
+	identity_map=True时同时开启identity map，块内orm按主键get同一行只查询一次
+	with db.connection():
+		db.select(...)
+		db.update(...)
+	"""
+	return _ConnectionCtx(identity_map)
+
+def identity_map():
+	"""返回当前连接上下文的identity map（dict），未开启时返回None"""
+	return _dbCtx.identity_map
+
+def shareable():
+	"""
+	当前上下文读到的行能否放入进程间共享的缓存
+	事务中或写过之后读到的可能是未提交（之后回滚）的数据，只属于当前上下文
+	"""
+	return not _dbCtx.is_init() or (_dbCtx.transaction == 0 and not _dbCtx.wrote)
+
+def transaction():
+	"""
+	返回一个事务上下文，用于with语句，可以嵌套，最外层结束时提交，出现异常时回滚
+	事务只属于当前的引擎（分片），块内切换到其他分片写入时抛出DBError，
+	不会在另一个连接上自动提交而逃出事务
+	with db.transaction():
+		db.insert(...)
+		db.update(...)
+	"""
+	return _TransactionCtx()
 
 def with_connection(func):
 	functools.wraps(func)
@@ -42,68 +237,172 @@ def with_transaction(func):
 	def _wrapper(*args, **kw):
 		with _TransactionCtx():
 			return func(*args, **kw)
-		return _wrapper
+	return _wrapper
+
+def _row_maker(row_type, names):
+	"""返回一个把一行values构造成row_type对象的函数"""
+	if row_type is None:
+		row_type = _row_type or Dict
+	if issubclass(row_type, Row):
+		return _row_class(names)
+	return lambda values: row_type(names, values)
 
 @with_connection	
-def _select(sql, first, *args):
+def _select(sql, first, *args, **kw):
 	global _dbCtx
-	cursor = None
-
-	sql = sql.replace('?','%s')
-	logging.info('SQL: %s, ARGS: %s' % (sql, args)) 
+	#primary=True时总在主库上读，不读可能落后的从库
+	conn = _dbCtx.connection if kw.get('primary') else _dbCtx.reader()
+	stmt, cursor, cached = conn.statement(sql, kw.get('prepare', True))
+	logging.info('SQL: %s, ARGS: %s' % (stmt, args)) 
 	try:
-		cursor = _dbCtx.connection.cursor()
-		cursor.execute(sql, args)
+		cursor.execute(stmt, args)
 		if cursor.description:
 			names = [x[0] for x in cursor.description]
+		make_row = _row_maker(kw.get('row_type'), names)
 		if first:
 			values = cursor.fetchone()
+			if cached:
+				#缓存的cursor会被复用，需要读完剩余的结果
+				cursor.fetchall()
 			if not values:
 				return None
-			return Dict(names, values)
-		return [Dict(names, x) for x in cursor.fetchall()]
+			return make_row(values)
+		return [make_row(x) for x in cursor.fetchall()]
+	except:
+		if cached:
+			conn.discard_statement(sql)
+		raise
 	finally:
-		if cursor:
+		if not cached:
 			cursor.close()
 
-def selectone(sql, *args):
+def selectone(sql, *args, **kw):
 	"""
 	执行sql，返回一条结果
 	如果无结果，返回None
 	如果有多个结果，返回第一条结果
+	kw可传入row_type=Dict/Row
+	kw可传入prepare=False，不使用预编译语句缓存（如参数个数不固定的 in (...)）
+	kw可传入primary=True，配置了从库时也在主库上读
 	"""
-	return _select(sql, True, *args)
+	return _select(sql, True, *args, **kw)
 
-def select(sql, *args):
+def select(sql, *args, **kw):
 	"""
 	执行sql,返回多条结果
+	kw可传入row_type=Dict/Row
+	kw可传入prepare=False，不使用预编译语句缓存（如参数个数不固定的 in (...)）
+	kw可传入primary=True，配置了从库时也在主库上读
 	"""
-	return _select(sql, False, *args)
+	return _select(sql, False, *args, **kw)
+
+def select_int(sql, *args, **kw):
+	"""执行sql，返回第一行第一列的整数值，如 select count(*) from user"""
+	d = _select(sql, True, *args, row_type=Row, prepare=kw.get('prepare', True))
+	return int(d[0]) if d else 0
+
+def iter_select(sql, *args, **kw):
+	"""
+	执行sql，返回一个逐行产生结果的generator
+	使用非缓冲cursor，每次用fetchmany读取batch_size行，内存占用与结果集大小无关
+	事务外使用从连接池单独取出的连接，直到generator耗尽或被关闭才归还
+	事务内使用事务的连接，此时在遍历结束前不能执行其他sql
+	kw可传入shard，在指定的分片上执行（generator挂起时不能依赖线程的引擎上下文）
+	for row in db.iter_select('select * from comment where blog_id=?', blog_id, batch_size=500):
+		...
+	"""
+	batch_size = kw.pop('batch_size', 100)
+	row_type = kw.pop('row_type', None)
+	shard = kw.pop('shard', None)
+	if kw:
+		raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw))
+	if shard is not None and shard != _dbCtx.shard:
+		conn, own = _LazyConnection(True, _get_engine(shard)), True
+	elif _dbCtx.is_init() and _dbCtx.transaction > 0:
+		conn, own = _dbCtx.connection, False
+	else:
+		conn, own = _LazyConnection(not (_dbCtx.is_init() and _dbCtx.sticky())), True
+	stmt = conn.engine.statement(sql)
+	logging.info('SQL: %s, ARGS: %s' % (stmt, args))
+	cursor = None
+	try:
+		cursor = conn.cursor()
+		cursor.execute(stmt, args)
+		names = [x[0] for x in cursor.description] if cursor.description else []
+		make_row = _row_maker(row_type, names)
+		while True:
+			rows = cursor.fetchmany(batch_size)
+			if not rows:
+				break
+			for x in rows:
+				yield make_row(x)
+	finally:
+		if cursor:
+			_close_cursor(cursor)
+		if own:
+			conn.cleanup()
+
+def _check_writable():
+	"""在其他引擎的事务中切换到分片后不能写入，写入会在分片的连接上单独提交"""
+	if _dbCtx.outer_transaction:
+		raise DBError('cannot write to shard %s inside a transaction on another engine' % _dbCtx.shard)
 
 @with_connection
-def _update(sql, *args):
+def _update(sql, *args, **kw):
 	"""
 	执行update语句，返回update行数
 	"""
 	global _dbCtx
-	cursor = None
-	sql = sql.replace('?', '%s')
-	logging.warning('SQL: %s, ARGS: %s' %(sql, args))
+	_check_writable()
+	stmt, cursor, cached = _dbCtx.connection.statement(sql, kw.get('prepare', True))
+	logging.warning('SQL: %s, ARGS: %s' %(stmt, args))
+	_dbCtx.wrote = True
 	try:
-		cursor = _dbCtx.connection.cursor()
-		cursor.execute(sql, args)
+		cursor.execute(stmt, args)
 		r = cursor.rowcount
 		if _dbCtx.transaction == 0:
 			#no transactions 可以提交
 			logging.info('auto commit')
 			_dbCtx.connection.commit()
 		return r
+	except:
+		if cached:
+			_dbCtx.connection.discard_statement(sql)
+		raise
 	finally:
-		if cursor:
+		if not cached:
+			cursor.close()
+
+def update(sql, *args, **kw):
+	"""
+	执行sql，返回影响的行数
+	参数个数不固定的sql（如 in (...)）传入prepare=False，避免占用预编译语句缓存
+	"""
+	return _update(sql, *args, **kw)
+
+@with_connection
+def update_many(sql, args_list):
+	"""
+	用executemany对每组参数执行同一条sql，所有行在一个事务中提交
+	返回影响的总行数
+	"""
+	global _dbCtx
+	args_list = list(args_list)
+	if not args_list:
+		return 0
+	_check_writable()
+	stmt = _dbCtx.connection.engine.statement(sql)
+	logging.warning('SQL: %s, ARGS: %d rows' % (stmt, len(args_list)))
+	_dbCtx.wrote = True
+	with _TransactionCtx():
+		cursor = _dbCtx.connection.cursor()
+		try:
+			cursor.executemany(stmt, args_list)
+			return cursor.rowcount
+		finally:
 			cursor.close()
 
-def update(sql, *args):
-	return _update(sql, *args)
+_insert_sqls = {}
 
 @with_connection
 def insert(table, **kw):
@@ -120,10 +419,68 @@ def insert(table, **kw):
       ...
     IntegrityError: 1062 (23000): Duplicate entry '2000' for key 'PRIMARY'
     """
-	cols,args = zip(*kw.iteritems())
-	sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
-	logging.warning("sql: %s" %sql)
-	return _update(sql,*args)
+	cols = tuple(sorted(kw))
+	key = (table, cols)
+	sql = _insert_sqls.get(key)
+	if sql is None:
+		sql = _insert_sqls[key] = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+	return _update(sql, *[kw[col] for col in cols])
+
+#单条insert语句的字节上限，应小于服务端的max_allowed_packet
+_MAX_PACKET = 1024 * 1024
+
+def _estimate_size(v):
+	"""估计一个参数在sql中占用的字节数"""
+	if isinstance(v, unicode):
+		return len(v) * 3 + 3
+	if isinstance(v, str):
+		return len(v) + 3
+	return 24
+
+@with_connection
+def insert_many(table, rows, max_packet=_MAX_PACKET, chunk_size=1000, columns=None):
+	"""
+	批量插入，rows为列相同的dict列表（给出columns时按columns的顺序取值），或者与columns顺序一致的值的tuple列表
+	多行拼成一条 insert ... values (...),(...) 执行，
+	每条语句不超过chunk_size行，估计的字节数不超过max_packet，参数个数不超过引擎的max_params
+	所有语句在同一个事务中执行，返回插入的行数
+	"""
+	rows = list(rows)
+	if not rows:
+		return 0
+	if not columns and not isinstance(rows[0], dict):
+		raise DBError('columns is required when rows are tuples')
+	cols = list(columns) if columns else rows[0].keys()
+	max_params = _dbCtx.connection.engine.max_params
+	if max_params:
+		chunk_size = max(1, min(chunk_size, max_params // len(cols)))
+	col_set = set(cols)
+	prefix = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+	placeholder = '(%s)' % ','.join(['?' for col in cols])
+	chunks = []
+	args = []
+	size = len(prefix)
+	for row in rows:
+		#dict按列名取值，tuple按columns的顺序
+		is_dict = isinstance(row, dict)
+		if len(row) != len(cols) or (is_dict and not col_set.issuperset(row)):
+			raise DBError('all rows must have the same columns: %s' % ','.join(cols))
+		values = [row[col] for col in cols] if is_dict else row
+		row_size = len(placeholder) + 1 + sum([_estimate_size(v) for v in values])
+		if args and (len(args) >= chunk_size or size + row_size > max_packet):
+			chunks.append(args)
+			args = []
+			size = len(prefix)
+		args.append(values)
+		size += row_size
+	chunks.append(args)
+	r = 0
+	with _TransactionCtx():
+		for chunk in chunks:
+			sql = prefix + ','.join([placeholder] * len(chunk))
+			#每块的行数不同，不使用预编译语句缓存
+			r += _update(sql, *[v for values in chunk for v in values], prepare=False)
+	return r
 
 class Dict(dict):
     """
@@ -144,47 +501,468 @@ class Dict(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+def _is_alive(conn):
+	"""检查连接是否可用，驱动不支持ping时认为可用"""
+	ping = getattr(conn, 'ping', None)
+	if ping is None:
+		return True
+	try:
+		ping()
+		return True
+	except Exception:
+		return False
+
+def _close_quietly(conn):
+	try:
+		conn.close()
+	except Exception:
+		logging.exception('close connection failed.')
+
+class Row(tuple):
+	"""
+	紧凑的只读行对象，按值保存在tuple中，不为每行建立hash表
+	取值方式与Dict兼容：row.name, row['name'], row.get('name'), row.keys()
+	每种列组合只生成一次子类，列名到位置的映射保存在子类上
+	"""
+	__slots__ = ()
+	_fields = ()
+	_index = {}
+
+	def __getitem__(self, key):
+		if isinstance(key, basestring):
+			try:
+				return tuple.__getitem__(self, self._index[key])
+			except KeyError:
+				raise KeyError(key)
+		return tuple.__getitem__(self, key)
+
+	def __getattr__(self, key):
+		try:
+			return tuple.__getitem__(self, self._index[key])
+		except KeyError:
+			raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+	def __iter__(self):
+		return iter(self._fields)
+
+	def __contains__(self, key):
+		return key in self._index
+
+	def get(self, key, default=None):
+		i = self._index.get(key)
+		return default if i is None else tuple.__getitem__(self, i)
+
+	def keys(self):
+		return list(self._fields)
+
+	def values(self):
+		return list(tuple.__iter__(self))
+
+	def items(self):
+		return zip(self._fields, tuple.__iter__(self))
+
+	def iterkeys(self):
+		return iter(self._fields)
+
+	def itervalues(self):
+		return tuple.__iter__(self)
+
+	def iteritems(self):
+		return iter(self.items())
+
+	def to_dict(self):
+		return Dict(self._fields, tuple.__iter__(self))
+
+	def __reduce__(self):
+		#子类是动态生成的，按列名和值pickle，载入时重新取得子类
+		return (_restore_row, (self._fields, tuple(tuple.__iter__(self))))
+
+	def __repr__(self):
+		return repr(dict(self.items()))
+
+_RE_IDENTIFIER = re.compile(r'^[A-Za-z_]\w*$')
+_row_classes = {}
+
+def _row_class(names):
+	"""按列名生成（并缓存）Row的子类，合法标识符的列名生成property以加快属性访问"""
+	key = tuple(names)
+	cls = _row_classes.get(key)
+	if cls is None:
+		attrs = dict(__slots__=(), _fields=key, _index=dict((n, i) for i, n in enumerate(key)))
+		for i, n in enumerate(key):
+			if _RE_IDENTIFIER.match(n) and not hasattr(Row, n):
+				attrs[str(n)] = property(operator.itemgetter(i))
+		cls = _row_classes[key] = type('Row', (Row,), attrs)
+	return cls
+
+def _restore_row(names, values):
+	"""unpickle Row"""
+	return _row_class(names)(values)
+
+class _ConnectionPool(object):
+	"""
+	有界连接池
+	min_size: 空闲回收时至少保留的连接数，创建时预先建立
+	max_size: 最多同时存在的连接数（空闲 + 使用中）
+	idle_timeout: 空闲超过该秒数的连接被关闭
+	timeout: 连接数达到上限时，等待归还连接的最长秒数
+	ping_interval: 空闲超过该秒数的连接在取出时先做健康检查，0表示每次都检查
+	"""
+	def __init__(self, connect, min_size=0, max_size=10, idle_timeout=300, timeout=30, ping_interval=30, on_close=None):
+		if max_size < 1 or min_size > max_size:
+			raise DBError('invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
+		self._connect = connect
+		self._on_close = on_close
+		self.min_size = min_size
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+		self.ping_interval = ping_interval
+		self._cond = threading.Condition()
+		#空闲连接栈：(connection, 归还时间)，后进先出，让热连接优先被复用
+		self._idle = []
+		self._size = 0
+		for i in range(min_size):
+			self._size += 1
+			self._idle.append((self._new_connection(), time.time()))
+
+	@property
+	def size(self):
+		return self._size
+
+	@property
+	def idle(self):
+		return len(self._idle)
+
+	@property
+	def in_use(self):
+		return self._size - len(self._idle)
+
+	def _new_connection(self):
+		logging.info('open new connection <%s>...' % self._size)
+		return self._connect()
+
+	def _evict_idle(self, now):
+		"""关闭空闲过久的连接，调用者需持有锁"""
+		if not self.idle_timeout:
+			return []
+		expired = []
+		keep = []
+		#栈底的连接最久未使用
+		for conn, last_used in self._idle:
+			if now - last_used > self.idle_timeout and self._size - len(expired) > self.min_size:
+				expired.append(conn)
+			else:
+				keep.append((conn, last_used))
+		self._idle = keep
+		self._size -= len(expired)
+		return expired
+
+	def acquire(self):
+		"""取出一个连接，池满时等待，超时抛出PoolTimeoutError"""
+		deadline = time.time() + self.timeout if self.timeout is not None else None
+		while True:
+			conn = last_used = None
+			expired = []
+			self._cond.acquire()
+			try:
+				now = time.time()
+				expired = self._evict_idle(now)
+				if self._idle:
+					conn, last_used = self._idle.pop()
+				elif self._size < self.max_size:
+					self._size += 1
+				else:
+					if deadline is not None and now >= deadline:
+						raise PoolTimeoutError('no connection available in %s seconds' % self.timeout)
+					self._cond.wait(None if deadline is None else deadline - now)
+					continue
+			finally:
+				self._cond.release()
+				for c in expired:
+					self._close_connection(c)
+			if conn is None:
+				try:
+					return self._new_connection()
+				except:
+					self._discard(None)
+					raise
+			if now - last_used < self.ping_interval or _is_alive(conn):
+				return conn
+			logging.warning('discard broken connection.')
+			self._discard(conn)
+
+	def release(self, conn, clean=False):
+		"""
+		归还连接，结束连接上未提交的隐式事务，失败则丢弃该连接
+		clean为True表示连接上的语句都已提交或回滚，不再rollback
+		"""
+		try:
+			if not clean:
+				conn.rollback()
+		except Exception:
+			logging.warning('reset connection failed, discard it.')
+			self._discard(conn)
+			return
+		self._cond.acquire()
+		try:
+			self._idle.append((conn, time.time()))
+			self._cond.notify()
+		finally:
+			self._cond.release()
+
+	def _discard(self, conn):
+		self._cond.acquire()
+		try:
+			self._size -= 1
+			self._cond.notify()
+		finally:
+			self._cond.release()
+		if conn is not None:
+			self._close_connection(conn)
+
+	def _close_connection(self, conn):
+		if self._on_close:
+			self._on_close(conn)
+		_close_quietly(conn)
+
+	def close(self):
+		"""关闭所有空闲连接"""
+		self._cond.acquire()
+		try:
+			idle = self._idle
+			self._idle = []
+			self._size -= len(idle)
+		finally:
+			self._cond.release()
+		for conn, last_used in idle:
+			self._close_connection(conn)
+
+def _close_cursor(cursor):
+	try:
+		cursor.close()
+	except Exception:
+		logging.exception('close cursor failed.')
+
+class _StatementCache(object):
+	"""
+	单个物理连接上的预编译语句LRU缓存
+	key为原始的?风格sql，value为(改写后的sql, 预编译的cursor)
+	驱动不支持预编译时退化为缓存普通cursor
+	"""
+	def __init__(self, connection, size, rewrite):
+		self._connection = connection
+		self.size = size
+		#把?风格的sql改写为驱动的占位符
+		self._rewrite = rewrite
+		self._statements = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self._statements)
+
+	def _new_cursor(self):
+		try:
+			return self._connection.cursor(prepared=True)
+		except TypeError:
+			return self._connection.cursor()
+
+	def get(self, sql):
+		entry = self._statements.pop(sql, None)
+		if entry is None:
+			self.misses += 1
+			if len(self._statements) >= self.size:
+				old_sql, (old_stmt, old_cursor) = self._statements.popitem(last=False)
+				self.evictions += 1
+				_close_cursor(old_cursor)
+			entry = (self._rewrite(sql), self._new_cursor())
+		else:
+			self.hits += 1
+		self._statements[sql] = entry
+		return entry
+
+	def discard(self, sql):
+		entry = self._statements.pop(sql, None)
+		if entry:
+			_close_cursor(entry[1])
+
+	def close(self):
+		for stmt, cursor in self._statements.itervalues():
+			_close_cursor(cursor)
+		self._statements.clear()
+
 class _Engine(object):
-	"""docstring for _Engine"""
-	def __init__(self, connect):
-		self.connect = connect
+	"""
+	数据库引擎，持有主库和从库的连接池，以及每个连接上的预编译语句缓存
+	replicas: 从库的connect函数列表，事务外的读操作分发到从库
+	read_your_writes: 同一个连接上下文中写过主库之后，读操作也走主库
+	dialect: 'mysql'或'sqlite'，决定参数占位符和单条语句的参数个数上限
+	"""
+	def __init__(self, connect, statement_cache_size=64, replicas=(), read_your_writes=True, dialect='mysql', **pool_kw):
+		self.statement_cache_size = statement_cache_size
+		self.read_your_writes = read_your_writes
+		self.dialect = dialect
+		#sqlite原生支持?，不需要改写sql；旧版本的sqlite最多999个参数
+		self.placeholder = '?' if dialect == 'sqlite' else '%s'
+		self.max_params = 999 if dialect == 'sqlite' else None
+		self._statements = {}
+		self._statements_lock = threading.Lock()
+		#已关闭连接上的统计，保证计数单调递增
+		self._retired_stats = dict(hits=0, misses=0, evictions=0)
+		self.pool = _ConnectionPool(connect, on_close=self._drop_statements, **pool_kw)
+		self.replicas = [_ConnectionPool(c, on_close=self._drop_statements, **pool_kw) for c in replicas]
+		self._next_replica = itertools.count()
 
 	def connect(self):
-		return self.connect
+		return self.pool.acquire()
+
+	def statement(self, sql):
+		"""把?风格的sql改写为驱动的占位符"""
+		if self.placeholder == '?':
+			return sql
+		return sql.replace('?', self.placeholder)
+
+	def release(self, conn):
+		self.pool.release(conn)
+
+	def pool_for(self, readonly=False):
+		"""
+		返回取连接的连接池
+		只读且有从库时，选使用中连接最少的从库，相同时轮询
+		"""
+		if not readonly or not self.replicas:
+			return self.pool
+		n = len(self.replicas)
+		start = next(self._next_replica)
+		best = None
+		for i in range(n):
+			pool = self.replicas[(start + i) % n]
+			if best is None or pool.in_use < best.in_use:
+				best = pool
+		return best
+
+	def statement_cache(self, conn):
+		"""返回连接上的语句缓存，未开启缓存时返回None"""
+		if not self.statement_cache_size:
+			return None
+		cache = self._statements.get(id(conn))
+		if cache is None:
+			cache = _StatementCache(conn, self.statement_cache_size, self.statement)
+			with self._statements_lock:
+				self._statements[id(conn)] = cache
+		return cache
+
+	def _drop_statements(self, conn):
+		with self._statements_lock:
+			cache = self._statements.pop(id(conn), None)
+			if cache is not None:
+				for k in self._retired_stats:
+					self._retired_stats[k] += getattr(cache, k)
+		if cache is not None:
+			cache.close()
+
+	def statement_stats(self):
+		with self._statements_lock:
+			stats = Dict(statements=0, **self._retired_stats)
+			for cache in self._statements.itervalues():
+				stats.hits += cache.hits
+				stats.misses += cache.misses
+				stats.evictions += cache.evictions
+				stats.statements += len(cache)
+		return stats
+
+def _get_engine(shard=None):
+	"""返回分片的引擎，shard为None时返回当前线程的引擎"""
+	if shard is None:
+		return _dbCtx.engine or engine
+	try:
+		return engines[shard]
+	except KeyError:
+		raise DBError('unknown shard: %s' % shard)
 
 class _LazyConnection(object):
-	"""惰性连接对象"""
-	def __init__(self):
+	"""惰性连接对象，第一次使用时从创建时所在引擎的连接池取出连接，readonly时从从库取出"""
+	def __init__(self, readonly=False, engine=None):
 		self.connection = None
+		self.readonly = readonly
+		self._engine = engine or _get_engine()
+		self._pool = None
+		#最近一次commit或rollback之后没有再执行语句
+		self._clean = True
+
+	@property
+	def engine(self):
+		return self._engine
+
+	def _connect(self):
+		self._pool = self._engine.pool_for(self.readonly)
+		self.connection = self._pool.acquire()
 
 	def cursor(self):
 		if self.connection is None:
-			_connection = engine.connect()
-			self.connection = _connection
-		return _connection.cursor()
+			self._connect()
+		self._clean = False
+		return self.connection.cursor()
+
+	def statement(self, sql, prepare=True):
+		"""
+		返回(改写后的sql, cursor, 是否为缓存的cursor)
+		缓存的cursor由连接上的语句缓存管理，调用者不能关闭
+		prepare=False时不使用缓存，返回普通的cursor
+		"""
+		if self.connection is None:
+			self._connect()
+		self._clean = False
+		cache = self._engine.statement_cache(self.connection) if prepare else None
+		if cache is None:
+			return self._engine.statement(sql), self.connection.cursor(), False
+		stmt, cursor = cache.get(sql)
+		return stmt, cursor, True
+
+	def discard_statement(self, sql):
+		cache = self._engine.statement_cache(self.connection)
+		if cache is not None:
+			cache.discard(sql)
 
 	def commit(self):
-		self.connection.commit()
+		if self.connection is not None:
+			self.connection.commit()
+			self._clean = True
 
 	def rollback(self):
-		self.connection.rollback()
+		if self.connection is not None:
+			self.connection.rollback()
+			self._clean = True
 
 	def cleanup(self):
 		if self.connection is not None:
 			_connection = self.connection
 			self.connection = None
-			_connection.close()
+			self._pool.release(_connection, self._clean)
+			self._clean = True
 
 class _DbCtx(threading.local):
 	"""数据库上下文对象，创建与释放连接"""
 	def __init__(self):
 		self.connection = None
+		self.replica = None
 		self.transaction = 0
+		self.wrote = False
+		self.identity_map = None
+		#当前的分片名和引擎，None表示缺省的引擎
+		self.shard = None
+		self.engine = None
+		#切换到分片时外层的引擎上是否有未结束的事务
+		self.outer_transaction = False
 
 	def init(self):
 		if self.connection is None:
 			self.connection = _LazyConnection()
+			self.replica = _LazyConnection(readonly=True) if _get_engine().replicas else None
 			self.transaction = 0
+			self.wrote = False
 
 	def is_init(self):
 		return self.connection is not None
@@ -192,28 +970,88 @@ class _DbCtx(threading.local):
 	def cursor(self):
 		return self.connection.cursor()
 
+	def sticky(self):
+		"""是否需要在主库上读：事务中，或开启read_your_writes且已经写过"""
+		return self.transaction > 0 or (self.wrote and _get_engine().read_your_writes)
+
+	def reader(self):
+		"""返回执行读操作的连接"""
+		if self.replica is None or self.sticky():
+			return self.connection
+		return self.replica
+
 	def cleanup(self):
 		self.connection.cleanup()
 		self.connection = None
+		if self.replica is not None:
+			self.replica.cleanup()
+			self.replica = None
 
 _dbCtx = _DbCtx()
 
 class _ConnectionCtx(object):
 	"""连接上下文，用于自动创建与释放连接"""
+	def __init__(self, identity_map=False):
+		self.identity_map = identity_map
+
 	def __enter__(self):
 		global _dbCtx
 		self.should_cleanup = False
+		self.should_clear_map = False
 		if not _dbCtx.is_init():
 			_dbCtx.init()
 			self.should_cleanup = True
+		if self.identity_map and _dbCtx.identity_map is None:
+			_dbCtx.identity_map = {}
+			self.should_clear_map = True
 		return self
 
 
 	def __exit__(self, exc_type, exc_value, exc_backtrace):
 		global _dbCtx
+		if self.should_clear_map:
+			_dbCtx.identity_map = None
 		if self.should_cleanup:
 			_dbCtx.cleanup()
 
+class _EngineCtx(object):
+	"""
+	切换当前线程的引擎（分片）
+	进入时保存当前的连接状态，块内在分片上使用新的惰性连接，退出时释放并恢复
+	外层有事务时块内只能读，写入抛出DBError
+	"""
+	_STATE = ('connection', 'replica', 'transaction', 'wrote', 'shard', 'engine', 'outer_transaction')
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		global _dbCtx
+		self.saved = None
+		if self.name is None or self.name == _dbCtx.shard:
+			return self
+		eng = _get_engine(self.name)
+		self.saved = [getattr(_dbCtx, k) for k in self._STATE]
+		_dbCtx.outer_transaction = _dbCtx.outer_transaction or _dbCtx.transaction > 0
+		_dbCtx.connection = None
+		_dbCtx.replica = None
+		_dbCtx.transaction = 0
+		_dbCtx.wrote = False
+		_dbCtx.shard = self.name
+		_dbCtx.engine = eng
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		global _dbCtx
+		if self.saved is None:
+			return
+		try:
+			if _dbCtx.is_init():
+				_dbCtx.cleanup()
+		finally:
+			for k, v in zip(self._STATE, self.saved):
+				setattr(_dbCtx, k, v)
+
 class _TransactionCtx(object):
 	"""事务嵌套
 	需要计数
@@ -221,25 +1059,25 @@ class _TransactionCtx(object):
 
 	def __enter__(self):
 		global _dbCtx
-		shelf.should_close_conn = False
+		self.should_close_conn = False
 		if not _dbCtx.is_init():
 			_dbCtx.init()
 			self.should_close_conn = True
-		_dbCtx.transactions += 1
-		logging.info('begin transaction ...' if _dbCtx.transactions == 1 else 'join current transaction...')
+		_dbCtx.transaction += 1
+		logging.info('begin transaction ...' if _dbCtx.transaction == 1 else 'join current transaction...')
 		return self
 
 	def __exit__(self,exc_type, exc_value, exc_traceback):
 		global _dbCtx
-		_dbCtx -= 1
+		_dbCtx.transaction -= 1
 		try:
-			if _dbCtx.transactions == 0:
+			if _dbCtx.transaction == 0:
 				if exc_type is None:
 					self.commit()
 				else:
 					self.rollback()
 		finally:
-			if should_close_conn:
+			if self.should_close_conn:
 				_dbCtx.cleanup()
 
 	def commit(self):
@@ -257,6 +1095,9 @@ class _TransactionCtx(object):
 		global _dbCtx
 		logging.warning('rollback transaction...')
 		_dbCtx.connection.rollback()
+		#回滚后map中的实例可能与数据库不一致
+		if _dbCtx.identity_map:
+			_dbCtx.identity_map.clear()
 		logging.warning('rollback OK ......')
 
 		
@@ -268,6 +1109,9 @@ class DBError(Exception):
 class MultiColumnError(DBError):
 	pass
 
+class PoolTimeoutError(DBError):
+	pass
+
 
 if __name__ == '__main__':
 	logging.basicConfig(level  = logging.DEBUG)
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import logging
+import re
+import json
+import base64
+import operator
 import db
+import cache
 import time
 
 
@@ -33,21 +38,41 @@ orm模块设计的原因：
             最后 id/name 要变成 user实例的属性
 """
 _triggers = frozenset(['pre_insert','pre_update','pre_delete'])
+_MISSING = object()
 
-def _gentable(table_name,mappings):
+#各方言建表语句的结尾
+_TABLE_OPTIONS = {
+    'mysql': ') engine=innodb default charset=utf8;',
+    'sqlite': ');',
+}
+
+def _gentable(table_name, mappings, dialect='mysql'):
+    """生成建表语句，dialect为'mysql'或'sqlite'，两者都接受字段的ddl类型名和反引号"""
+    if dialect not in _TABLE_OPTIONS:
+        raise ValueError('unsupported dialect: %s' % dialect)
     pk = None
-    sql = ['-- generating sql for table %s:' % table_name,'create table %s (' %table_name ]
-    for f in sorted(mappings.values(), lambda x,y: cmp(x._order, y._order)):
+    sql = ['-- generating sql for table %s:' % table_name,'create table `%s` (' %table_name ]
+    for f in sorted(mappings.values(), key=lambda f: f._order):
         if not hasattr(f, 'ddl'):
             raise StandardError('fidld %s has no ddl' %f)
         ddl = f.ddl
         nullable = f.nullable
         if f.primary_key:
             pk = f.name
-        sql.append(' `%s` %s, ' % (f.name, ddl) if nullable else ' `%s` %s not null,' % (f.name, ddl))
-        sql.append(' primary key (`%s`)' % pk)
-        sql.append(');')
-        return '\n'.join(sql)
+        sql.append(' `%s` %s,' % (f.name, ddl) if nullable else ' `%s` %s not null,' % (f.name, ddl))
+    sql.append(' primary key (`%s`)' % pk)
+    sql.append(_TABLE_OPTIONS[dialect])
+    return '\n'.join(sql)
+
+def _tuple_getter(keys):
+    """返回一个按keys取值、总是返回tuple的函数"""
+    if len(keys) == 1:
+        getter = operator.itemgetter(keys[0])
+        return lambda obj: (getter(obj),)
+    return operator.itemgetter(*keys)
+
+def _update_sql(table, pk, columns):
+    return 'update `%s` set %s where `%s` = ?' % (table, ','.join(['`%s` = ?' % col for col in columns]), pk)
 
 class Field(object):
     """
@@ -70,6 +95,8 @@ class Field(object):
         self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl','')
+        #lazy字段不在缺省的select中，第一次访问时才查询
+        self.lazy = kw.get('lazy', False)
         self._order = Field._count
         Field._count += 1
 
@@ -198,6 +225,10 @@ class ModelMetaClass(type):
                     if v.nullable:
                         logging.warning("Note: change priamry key %s to non_nullable" %v.name)
                         v.nullable = False
+                    #primary key cannot be lazy
+                    if v.lazy:
+                        logging.warning("Note: change primary key %s to non_lazy" %v.name)
+                        v.lazy = False
                     primary_key = v
                 mappings[k] = v
         #check if it has a primary key
@@ -213,11 +244,40 @@ class ModelMetaClass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] =primary_key
-        #attrs['__sql__'] = lambda self : _gentable(attrs['__table__'], mappings)
-        attrs['__sql__'] = _gentable(attrs['__table__'], mappings)
+        #Model.__sql__() 返回当前引擎方言的建表语句，也可以传入dialect='mysql'/'sqlite'
+        table = attrs['__table__']
+        attrs['__sql__'] = staticmethod(lambda dialect=None: _gentable(table, mappings, dialect or db.dialect()))
+        #缺省select的列，有lazy字段时不选出lazy字段
+        fields = sorted(mappings.values(), key=lambda f: f._order)
+        if any([f.lazy for f in fields]):
+            attrs['__select__'] = ','.join(['`%s`' % f.name for f in fields if not f.lazy])
+        else:
+            attrs['__select__'] = '*'
+        #预先生成增删改查的sql和取参数的函数，每次调用只需构造参数tuple并执行
+        pk = primary_key.name
+        insertable = [f.name for f in fields if f.insertable]
+        attrs['__insert_fields__'] = tuple([(f.name, f) for f in fields if f.insertable])
+        attrs['__insert_columns__'] = tuple(insertable)
+        attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in insertable]), ','.join(['?'] * len(insertable)))
+        attrs['__insert_getter__'] = _tuple_getter(insertable)
+        attrs['__updatable__'] = tuple([f.name for f in fields if f.updatable])
+        #update的字段组合 => sql，全部字段的sql预先生成，只更新部分字段时按需生成
+        attrs['__update_sqls__'] = {attrs['__updatable__']: _update_sql(table, pk, attrs['__updatable__'])}
+        attrs['__get_sql__'] = 'select %s from `%s` where `%s` = ?' % (attrs['__select__'], table, pk)
+        attrs['__delete_sql__'] = 'delete from `%s` where `%s` = ?' % (table, pk)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
+        #__cache__ = dict(ttl=60, maxsize=10000) 开启按主键的进程内缓存
+        cache_config = attrs.get('__cache__')
+        attrs['__cache_backend__'] = cache.create_backend(cache_config) if cache_config else None
+        attrs['__cache_ttl__'] = cache_config.get('ttl') if cache_config else None
+        #__shard__ = staticmethod(db.hash_shard) 按主键分片，函数返回主键所在的分片名
+        shard = attrs.get('__shard__')
+        if shard is not None and not isinstance(shard, staticmethod):
+            shard = staticmethod(shard)
+        attrs['__shard__'] = shard
+        attrs['__pk_where__'] = re.compile(r'^\s*where\s+`?%s`?\s*=\s*\?\s*$' % re.escape(primary_key.name), re.IGNORECASE)
         return type.__new__(cls, name, bases, attrs)
         
 class Model(dict):
@@ -232,50 +292,362 @@ class Model(dict):
         super(Model, self).__init__(**kw)
 
     def __getattr__(self, key):
-        """get时生效"""
+        """get时生效，没有查询出的字段（lazy字段或投影外的字段）在第一次访问时查询"""
         try:
             return self[key]
         except KeyError:
+            if key in self.__dict__.get('_unloaded', ()):
+                return self._load_field(key)
             raise AttributeError('Dict Object has no attribute %s' %key)
 
+    def _load_field(self, key):
+        """查询一个没有载入的字段"""
+        pk = self.__primary_key__.name
+        with db.use_engine(self._shard_of(self[pk])):
+            d = db.selectone('select `%s` from %s where `%s` = ?' % (key, self.__table__, pk), self[pk], row_type=db.Row)
+        if d is None:
+            raise AttributeError('cannot load field %s: row %s not found' % (key, self[pk]))
+        dict.__setitem__(self, key, d[key])
+        self._unloaded.discard(key)
+        return d[key]
+
+    @classmethod
+    def _from_row(cls, d):
+        """用查询出的行构造实例，记录没有查询出的字段"""
+        inst = cls.__new__(cls)
+        dict.__init__(inst, d.items())
+        inst.__dict__['_dirty'] = set()
+        if len(d) < len(cls.__mappings__):
+            inst.__dict__['_unloaded'] = set(cls.__mappings__).difference(d.keys())
+        return inst
+
+    @classmethod
+    def _from_dict(cls, d):
+        """用部分字段的dict构造实例，修改记录为给出的字段，update时只写这些字段"""
+        if cls.__primary_key__.name not in d:
+            raise ValueError('missing primary key %s in %s' % (cls.__primary_key__.name, d))
+        inst = cls._from_row(d)
+        inst.__dict__['_dirty'] = set(d).intersection(cls.__mappings__)
+        return inst
+
+    @classmethod
+    def _shard_of(cls, pk):
+        """返回主键所在的分片名，Model没有分片或已经在分片上下文中时返回None"""
+        if cls.__shard__ is None or db.current_shard() is not None:
+            return None
+        return cls.__shard__(pk)
+
+    @classmethod
+    def _shards(cls):
+        """返回查询需要访问的分片名列表，不需要分散到各分片时返回[None]"""
+        if cls.__shard__ is None or db.current_shard() is not None:
+            return [None]
+        return db.shard_names() or [None]
+
+    @classmethod
+    def _gather(cls, func):
+        """在需要访问的分片上并行执行func，返回结果列表"""
+        shards = cls._shards()
+        if shards == [None]:
+            return [func()]
+        return db.scatter(func, shards)
+
+    @classmethod
+    def _shard_order(cls, where, args):
+        """需要合并多个分片的结果时，解析where结尾的order by和limit，否则返回 ([], None)"""
+        if cls._shards() == [None]:
+            return [], None
+        return _parse_order_limit(where, args)
+
+    @classmethod
+    def _group_by_shard(cls, items, pk_of):
+        """把items按主键所在的分片分组，返回 分片名 => items 的dict"""
+        groups = {}
+        for x in items:
+            groups.setdefault(cls._shard_of(pk_of(x)), []).append(x)
+        return groups
+
+    @classmethod
+    def _select_columns(cls, columns=None):
+        """
+        返回select的列
+        columns为None时选出除lazy字段以外的所有列，否则只选出columns中的列
+        主键总是被选出，以便之后载入其他字段
+        """
+        if columns is None:
+            return cls.__select__
+        pk = cls.__primary_key__.name
+        for col in columns:
+            if col not in cls.__mappings__:
+                raise ValueError('unknown field: %s' % col)
+        return ','.join(['`%s`' % col for col in [pk] + [c for c in columns if c != pk]])
+
     def __setattr__(self, key, value):
         """set时生效"""
         self[key] = value
 
+    def __setitem__(self, key, value):
+        """
+        从数据库载入或保存过的实例，记录修改过的字段，update时只写这些字段
+        给没有载入的字段赋值后，该字段视为已载入
+        """
+        if key in self.__mappings__:
+            dirty = self.__dict__.get('_dirty')
+            if dirty is not None and dict.get(self, key, _MISSING) != value:
+                dirty.add(key)
+            self.__dict__.get('_unloaded', set()).discard(key)
+        dict.__setitem__(self, key, value)
+
     @classmethod
-    def get(cls, pk):
-        """get by primary_key"""
-        d = db.selectone('select * from %s where %s = ?' %(cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+    def get(cls, pk, columns=None):
+        """
+        get by primary_key
+        开启identity map时（db.connection(identity_map=True)），同一上下文中重复get返回同一个实例
+        columns: 只查询这些字段，其他字段在访问时再查询
+        """
+        inst = cls._lookup(pk)
+        if inst is None:
+            if columns is None:
+                sql = cls.__get_sql__
+            else:
+                sql = 'select %s from `%s` where `%s` = ?' % (cls._select_columns(columns), cls.__table__, cls.__primary_key__.name)
+            cache = cls._cacheable(columns)
+            with db.use_engine(cls._shard_of(pk)):
+                d = db.selectone(sql, pk, row_type=db.Row, primary=cache)
+            inst = cls._loaded(pk, d, cache) if d else None
+        return inst
 
     @classmethod
-    def find_first(cls, where, *args):
-        """通过where语句查询，返回一个查询结果。如果有多个结果，则返回一个第一个"""
-        d = db.selectone('select * from %s %s' %(cls.__table__, where),*args)
-        return cls(**d) if d else None
+    def get_many(cls, pks, chunk_size=500, columns=None):
+        """
+        按主键批量查询，返回 主键 => 实例 的dict，不存在的主键不在结果中
+        先查identity map和缓存，剩余的主键每chunk_size个执行一条 where pk in (...)
+        """
+        result = {}
+        missing = []
+        for pk in set(pks):
+            inst = cls._lookup(pk)
+            if inst is None:
+                missing.append(pk)
+            else:
+                result[pk] = inst
+        pk_name = cls.__primary_key__.name
+        cache = cls._cacheable(columns)
+        for shard, keys in cls._group_by_shard(missing, lambda pk: pk).iteritems():
+            with db.use_engine(shard):
+                for i in range(0, len(keys), chunk_size):
+                    chunk = keys[i:i + chunk_size]
+                    L = db.select('select %s from %s where `%s` in (%s)' % (cls._select_columns(columns), cls.__table__, pk_name, ','.join(['?'] * len(chunk))), *chunk, row_type=db.Row, prepare=False, primary=cache)
+                    for d in L:
+                        result[d[pk_name]] = cls._loaded(d[pk_name], d, cache)
+        return result
 
     @classmethod
-    def find_all(cls, *args):
-        """将结果以一个列表返回"""
-        L = db.select('select * from %s' % cls.__table__)
-        return [cls(**d) for d in L]
+    def _lookup(cls, pk):
+        """在identity map和进程内缓存中查找实例，找不到返回None"""
+        m = db.identity_map()
+        if m is not None:
+            inst = m.get((cls, pk))
+            if inst is not None:
+                return inst
+        backend = cls.__cache_backend__
+        if backend is not None:
+            d = backend.get(cls._cache_key(pk))
+            if d is not None:
+                inst = cls._from_row(d)
+                if m is not None:
+                    m[(cls, pk)] = inst
+                return inst
+        return None
 
     @classmethod
-    def find_by(cls, where, *args):
-        """将符合where条件的结果以一个列表返回"""
-        L = db.select('select * from %s %s' %(cls.__table__, where),*args)
-        return [cls(**d) for d in L]
+    def _cacheable(cls, columns=None):
+        """
+        查询结果能否放入进程内缓存：开启了缓存，查询的是缺省的列，且不在事务中、没有写过
+        放入缓存的行在主库上读，避免从库的延迟把刚失效的旧值重新填入缓存
+        """
+        return cls.__cache_backend__ is not None and columns is None and db.shareable()
+
+    @classmethod
+    def _loaded(cls, pk, d, cache=True):
+        """用查询出的行构造实例，cache为True时放入进程内缓存，并放入identity map"""
+        backend = cls.__cache_backend__
+        if backend is not None and cache:
+            backend.set(cls._cache_key(pk), d, cls.__cache_ttl__)
+        inst = cls._from_row(d)
+        m = db.identity_map()
+        if m is not None:
+            m[(cls, pk)] = inst
+        return inst
+
+    def _saved(self):
+        """实例已写入数据库：清空修改记录，放入identity map"""
+        self.__dict__['_dirty'] = set()
+        m = db.identity_map()
+        if m is not None:
+            m[(self.__class__, getattr(self, self.__primary_key__.name))] = self
+
+    @classmethod
+    def _evict(cls, pks):
+        """把主键从identity map和进程内缓存中移除"""
+        m = db.identity_map()
+        if m:
+            for pk in pks:
+                m.pop((cls, pk), None)
+        backend = cls.__cache_backend__
+        if backend is not None:
+            for pk in pks:
+                backend.delete(cls._cache_key(pk))
+
+    @classmethod
+    def _cache_key(cls, pk):
+        return '%s:%s' % (cls.__table__, pk)
+
+    @classmethod
+    def cache_stats(cls):
+        """返回进程内缓存的统计，未开启缓存时返回None"""
+        backend = cls.__cache_backend__
+        return backend.stats() if backend is not None else None
+
+    @classmethod
+    def find_first(cls, where, *args, **kw):
+        """
+        通过where语句查询，返回一个查询结果。如果有多个结果，则返回一个第一个
+        开启缓存时，'where id=?' 这样按主键的查询走get的缓存
+        kw可传入columns，只查询这些字段
+        分片的Model取每个分片的第一条，按where中的order by合并后返回第一条
+        """
+        columns = kw.get('columns')
+        if (cls.__cache_backend__ is not None or cls.__shard__ is not None) and len(args) == 1 and cls.__pk_where__.match(where):
+            return cls.get(args[0], columns)
+        order, limit = cls._shard_order(where, args)
+        sql = 'select %s from %s %s' %(cls._select_columns(_with_order(columns, order)), cls.__table__, where)
+        L = _merge([[d] if d else [] for d in cls._gather(lambda: db.selectone(sql, *args, row_type=db.Row))], order)
+        return cls._from_row(L[0]) if L else None
+
+    @classmethod
+    def find_all(cls, *args, **kw):
+        """将结果以一个列表返回，kw可传入columns，只查询这些字段"""
+        sql = 'select %s from %s' % (cls._select_columns(kw.get('columns')), cls.__table__)
+        return [cls._from_row(d) for part in cls._gather(lambda: db.select(sql, row_type=db.Row)) for d in part]
+
+    @classmethod
+    def find_by(cls, where, *args, **kw):
+        """
+        将符合where条件的结果以一个列表返回，kw可传入columns，只查询这些字段
+        分片的Model并行查询所有分片，按where结尾的order by字段合并排序，再截取limit
+        分片的Model的where只支持 order by 字段 [asc|desc], ... limit n，需要offset时使用page()或query()
+        """
+        order, limit = cls._shard_order(where, args)
+        sql = 'select %s from %s %s' %(cls._select_columns(_with_order(kw.get('columns'), order)), cls.__table__, where)
+        L = _merge(cls._gather(lambda: db.select(sql, *args, row_type=db.Row)), order)
+        if limit is not None:
+            L = L[:limit]
+        return [cls._from_row(d) for d in L]
+
+    @classmethod
+    def page(cls, order_by='-created_at', after=None, limit=20, where=None, args=(), columns=None):
+        """
+        基于游标（keyset）的分页，返回 (实例列表, 下一页的游标)，没有下一页时游标为None
+        order_by: 排序字段，'-'前缀表示降序，主键作为第二排序字段保证顺序唯一
+        after: 上一页返回的游标，None表示第一页
+        where/args: 附加的过滤条件，如 where='`blog_id`=?', args=(blog_id,)
+        columns: 只查询这些字段
+        用 order_by字段 < 上一页最后一行的值 定位，深的分页与第一页代价相同
+        blogs, cursor = Blog.page(limit=10)
+        blogs, cursor = Blog.page(limit=10, after=cursor)
+        """
+        desc = order_by.startswith('-')
+        col = order_by.lstrip('-')
+        if col not in cls.__mappings__:
+            raise ValueError('cannot page by unknown field: %s' % col)
+        pk = cls.__primary_key__.name
+        op = '<' if desc else '>'
+        direction = 'desc' if desc else 'asc'
+        conds = ['(%s)' % where] if where else []
+        params = list(args)
+        if after:
+            value, last_pk = _decode_cursor(after)
+            conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (col, op, col, pk, op))
+            params.extend([value, value, last_pk])
+        if columns is not None and col not in columns:
+            columns = list(columns) + [col]
+        sql = 'select %s from %s %s order by `%s` %s, `%s` %s limit ?' % (
+            cls._select_columns(columns), cls.__table__, 'where %s' % ' and '.join(conds) if conds else '', col, direction, pk, direction)
+        params.append(limit + 1)
+        L = _merge(cls._gather(lambda: db.select(sql, *params, row_type=db.Row)), [(col, desc), (pk, desc)])
+        next_cursor = None
+        if len(L) > limit:
+            L = L[:limit]
+            next_cursor = _encode_cursor(L[-1][col], L[-1][pk])
+        return [cls._from_row(d) for d in L], next_cursor
+
+    @classmethod
+    def iter_all(cls, batch_size=100, columns=None):
+        """逐行返回所有结果的generator，不会一次性载入整张表，分片的Model依次遍历每个分片"""
+        sql = 'select %s from %s' % (cls._select_columns(columns), cls.__table__)
+        for shard in cls._shards():
+            for d in db.iter_select(sql, batch_size=batch_size, row_type=db.Row, shard=shard):
+                yield cls._from_row(d)
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        """逐行返回符合where条件的结果的generator，kw可传入batch_size和columns"""
+        columns = kw.pop('columns', None)
+        kw.setdefault('row_type', db.Row)
+        sql = 'select %s from %s %s' % (cls._select_columns(columns), cls.__table__, where)
+        for shard in cls._shards():
+            for d in db.iter_select(sql, *args, shard=shard, **kw):
+                yield cls._from_row(d)
+
+    @classmethod
+    def query(cls):
+        """
+        返回一个可组合的查询对象
+        User.query().filter(email=email).first()
+        Blog.query().filter(user_id=uid, created_at__lt=t).order_by('-created_at').limit(10).all()
+        """
+        return Query(cls)
 
     @classmethod
     def count_all(cls):
         """
         执行 select count(pk) from table 
         """
-        return db.select_int('select count(`%s`) from %s' %(cls.__primary_key__.name,cls.__table__))
+        sql = 'select count(`%s`) from %s' %(cls.__primary_key__.name,cls.__table__)
+        return sum(cls._gather(lambda: db.select_int(sql)))
 
     @classmethod
     def count_by(cls, where, *args):
-        return db.select_int('select count(`%s`) from %s %s' %(cls.__primary_key__.name,cls.__table__,where), *args)
+        sql = 'select count(`%s`) from %s %s' %(cls.__primary_key__.name,cls.__table__,where)
+        return sum(cls._gather(lambda: db.select_int(sql, *args)))
+
+    def _update_params(self):
+        """
+        执行pre_update，返回update语句和参数，最后一个参数是主键的值
+        从数据库载入或保存过的实例只更新修改过的字段，没有需要更新的字段时返回 (None, None)
+        """
+        if self.pre_update:
+            self.pre_update()
+
+        #没有载入的字段保持数据库中的值不变
+        unloaded = self.__dict__.get('_unloaded')
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None and not unloaded:
+            names = self.__updatable__
+        else:
+            names = tuple([k for k in self.__updatable__ if (not unloaded or k not in unloaded) and (dirty is None or k in dirty)])
+            if not names:
+                return None, None
+        for k in names:
+            if k not in self:
+                dict.__setitem__(self, k, self.__mappings__[k].default)
+        sql = self.__update_sqls__.get(names)
+        if sql is None:
+            sql = self.__update_sqls__[names] = _update_sql(self.__table__, self.__primary_key__.name, names)
+        args = [self[k] for k in names]
+        args.append(self[self.__primary_key__.name])
+        return sql, args
 
     def update(self):
         """
@@ -284,51 +656,367 @@ class Model(dict):
         可以通过属性来判断，该对象是否有这个字段
         如果有属性，就是用用户传入的值
         否则是用字段的default值
+        从数据库载入的实例只写修改过的字段，没有修改时不执行sql
         """
-        if self.pre_update:
-            self.pre_update()
-
-        L = []
-        args = []
-        for k,v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self,k):
-                     arg = getattr(self,k)
-                else:
-                    arg = v.default
-                    setattr(self,k,arg)
-                L.append("`%s` = ?" %k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr((self,pk)))
-        db.update('update `%s` set %s where %s = ?' %(self.__table__,','.join(L),pk),*args)
+        sql, args = self._update_params()
+        if sql is None:
+            return self
+        with db.use_engine(self._shard_of(args[-1])):
+            db.update(sql, *args)
+        self._evict(args[-1:])
+        self._saved()
         return self
 
+    @classmethod
+    def update_many(cls, instances):
+        """
+        批量更新，instances可以是实例或dict，每个实例都会执行pre_update
+        实例与update()相同；dict必须包含主键，只更新dict中给出的字段，其他字段保持数据库中的值
+        set子句相同的行用一次executemany执行，所有语句在一个事务中（分片的Model每个分片一个事务）
+        """
+        instances = [inst if isinstance(inst, cls) else cls._from_dict(inst) for inst in instances]
+        if not instances:
+            return instances
+        updates = []
+        for inst in instances:
+            sql, args = inst._update_params()
+            if sql is not None:
+                updates.append((sql, args))
+        for shard, items in cls._group_by_shard(updates, lambda u: u[1][-1]).iteritems():
+            groups = {}
+            for sql, args in items:
+                groups.setdefault(sql, []).append(args)
+            with db.use_engine(shard):
+                with db.transaction():
+                    for sql, args_list in groups.iteritems():
+                        db.update_many(sql, args_list)
+                        cls._evict([args[-1] for args in args_list])
+        for inst in instances:
+            inst._saved()
+        return instances
+
     def delete(self):
         """通过update接口执行sql
         sql: delete from 'user' where `id` = %s, args:(1090,)
         """
         self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self,pk),)
-        db.update('delete from `%s` where `%s`= ?' %(self.__table__,pk), *args)
+        args = (self[self.__primary_key__.name],)
+        with db.use_engine(self._shard_of(args[0])):
+            db.update(self.__delete_sql__, *args)
+        self._evict(args)
         return self
 
-    def insert(self):
-        """通过db的insert接口执行sql
-        sql: insert into `user` (`password`,`last_modified`,`id`,`name`) values (%s,%s,%s,%s)
-        args:('','','','')
+    @classmethod
+    def delete_many(cls, pks, chunk_size=500):
         """
+        按主键批量删除，pks中可以是主键值或实例
+        每chunk_size个主键执行一条 delete ... where pk in (...)，所有语句在一个事务中执行（分片的Model每个分片一个事务）
+        定义了pre_delete时，对传入的实例直接调用，只给出主键的行先按块查询出实例再调用
+        返回删除的行数
+        """
+        pk = cls.__primary_key__.name
+        r = 0
+        for shard, items in cls._group_by_shard(pks, lambda x: getattr(x, pk) if isinstance(x, cls) else x).iteritems():
+            with db.use_engine(shard):
+                r += cls._delete_chunks(items, chunk_size)
+        return r
+
+    @classmethod
+    def _delete_chunks(cls, items, chunk_size):
+        pk = cls.__primary_key__.name
+        r = 0
+        with db.transaction():
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                keys = [getattr(x, pk) if isinstance(x, cls) else x for x in chunk]
+                in_sql = ','.join(['?'] * len(keys))
+                if cls.pre_delete:
+                    loaded = [x for x in chunk if isinstance(x, cls)]
+                    raw = [x for x in chunk if not isinstance(x, cls)]
+                    if raw:
+                        L = db.select('select %s from `%s` where `%s` in (%s)' % (cls.__select__, cls.__table__, pk, ','.join(['?'] * len(raw))), *raw, row_type=db.Row, prepare=False)
+                        loaded.extend([cls._from_row(d) for d in L])
+                    for inst in loaded:
+                        inst.pre_delete()
+                r += db.update('delete from `%s` where `%s` in (%s)' % (cls.__table__, pk, in_sql), *keys, prepare=False)
+                cls._evict(keys)
+        return r
+
+    def _insert_args(self):
+        """执行pre_insert，填入缺省值，返回按__insert_columns__排列的参数tuple"""
         self.pre_insert and self.pre_insert()
-        params = {}
-        for k,v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self,k):
-                    setattr(self,k,v.default)
-                params[v.name] = self[k]
-        db.insert(self.__table__,**params)
+        unloaded = self.__dict__.get('_unloaded', ())
+        for k, f in self.__insert_fields__:
+            if k not in self:
+                if k in unloaded:
+                    self._load_field(k)
+                else:
+                    dict.__setitem__(self, k, f.default)
+        return self.__insert_getter__(self)
+
+    def insert(self):
+        """执行预先生成的insert语句
+        sql: insert into `user` (`id`,`email`,`password`,`admin`,`name`,`image`,`created_at`) values (?,?,?,?,?,?,?)
+        """
+        args = self._insert_args()
+        with db.use_engine(self._shard_of(self[self.__primary_key__.name])):
+            db.update(self.__insert_sql__, *args)
+        self._saved()
         return self
 
+    @classmethod
+    def insert_all(cls, instances):
+        """
+        批量插入，对每个实例执行pre_insert并填入缺省值
+        通过db.insert_many以多行insert语句在一个事务中写入
+        """
+        instances = list(instances)
+        rows = [(inst, inst._insert_args()) for inst in instances]
+        pk = cls.__primary_key__.name
+        for shard, items in cls._group_by_shard(rows, lambda row: row[0][pk]).iteritems():
+            with db.use_engine(shard):
+                db.insert_many(cls.__table__, [args for inst, args in items], columns=cls.__insert_columns__)
+        for inst in instances:
+            inst._saved()
+        return instances
+
+#filter支持的比较，field__op=value，没有op时为eq
+_QUERY_OPS = {
+    'eq': '=',
+    'ne': '<>',
+    'lt': '<',
+    'le': '<=',
+    'gt': '>',
+    'ge': '>=',
+    'in': 'in',
+}
+
+#查询形状 => 编译好的sql
+_compiled_queries = {}
+
+#只有offset时limit的取值，mysql没有表示不限制的写法，用最大的bigint unsigned
+_NO_LIMIT = dict(mysql=18446744073709551615, sqlite=-1)
+
+class Query(object):
+    """
+    可组合的查询，每个方法返回一个新的Query
+    sql只由查询的形状（字段、比较、排序、是否有limit）决定，参数单独绑定，
+    同一形状只编译一次，生成的sql相同，可以命中db的预编译语句缓存
+    有__in过滤时sql随参数个数变化，不使用预编译语句缓存
+    """
+    def __init__(self, model):
+        self._model = model
+        self._filters = ()
+        self._args = ()
+        self._order = ()
+        self._columns = None
+        self._limit = None
+        self._offset = None
+
+    def _clone(self, **kw):
+        q = Query.__new__(Query)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(kw)
+        return q
+
+    def filter(self, **kw):
+        """按 字段=值 过滤，多个条件为and，字段可以带后缀：__ne, __lt, __le, __gt, __ge, __in"""
+        filters = list(self._filters)
+        args = list(self._args)
+        for key in sorted(kw):
+            value = kw[key]
+            col, sep, op = key.partition('__')
+            op = op or 'eq'
+            if col not in self._model.__mappings__:
+                raise ValueError('unknown field: %s' % col)
+            if op not in _QUERY_OPS:
+                raise ValueError('unknown filter operator: %s' % op)
+            if op == 'in':
+                value = list(value)
+                filters.append((col, op, len(value)))
+                args.extend(value)
+            else:
+                filters.append((col, op, 1))
+                args.append(value)
+        return self._clone(_filters=tuple(filters), _args=tuple(args))
+
+    def order_by(self, *fields):
+        """排序字段，'-'前缀表示降序"""
+        for f in fields:
+            if f.lstrip('-') not in self._model.__mappings__:
+                raise ValueError('unknown field: %s' % f)
+        return self._clone(_order=self._order + fields)
+
+    def only(self, *columns):
+        """只查询这些字段，其他字段在访问时再查询"""
+        return self._clone(_columns=columns)
+
+    def limit(self, n):
+        return self._clone(_limit=n)
+
+    def offset(self, n):
+        return self._clone(_offset=n)
+
+    def _where(self):
+        conds = []
+        for col, op, n in self._filters:
+            if op == 'in':
+                conds.append('`%s` in (%s)' % (col, ','.join(['?'] * n)) if n else '1 = 0')
+            else:
+                conds.append('`%s` %s ?' % (col, _QUERY_OPS[op]))
+        return ' where %s' % ' and '.join(conds) if conds else ''
+
+    def _compile(self, kind):
+        """按查询形状编译sql并缓存"""
+        key = (kind, self._model, self._filters, self._order, self._columns, self._limit is not None, self._offset is not None)
+        sql = _compiled_queries.get(key)
+        if sql is None:
+            model = self._model
+            if kind == 'count':
+                sql = 'select count(`%s`) from `%s`%s' % (model.__primary_key__.name, model.__table__, self._where())
+            elif kind == 'exists':
+                sql = 'select 1 from `%s`%s limit 1' % (model.__table__, self._where())
+            else:
+                L = ['select %s from `%s`%s' % (model._select_columns(self._columns), model.__table__, self._where())]
+                if self._order:
+                    L.append(' order by %s' % ','.join(['`%s` desc' % f[1:] if f.startswith('-') else '`%s`' % f for f in self._order]))
+                if self._limit is not None or self._offset is not None:
+                    L.append(' limit ?')
+                if self._offset is not None:
+                    L.append(' offset ?')
+                sql = ''.join(L)
+            _compiled_queries[key] = sql
+        return sql
+
+    def _prepare(self):
+        """是否使用预编译语句缓存，__in的参数个数不固定时不使用"""
+        return not any([op == 'in' for col, op, n in self._filters])
+
+    def _select_args(self):
+        args = list(self._args)
+        if self._limit is not None:
+            args.append(self._limit)
+        elif self._offset is not None:
+            args.append(_NO_LIMIT[db.dialect()])
+        if self._offset is not None:
+            args.append(self._offset)
+        return args
+
+    def all(self):
+        """分片的Model并行查询所有分片，合并后按order_by排序，再截取offset/limit"""
+        q = self
+        sharded = self._model._shards() != [None]
+        order = [(f.lstrip('-'), f.startswith('-')) for f in self._order]
+        if sharded:
+            #投影查询时加上排序字段，每个分片都要取前offset+limit行
+            kw = dict(_columns=_with_order(self._columns, order))
+            if self._offset is not None:
+                kw.update(_offset=None, _limit=None if self._limit is None else self._limit + self._offset)
+            q = self._clone(**kw)
+        sql = q._compile('select')
+        args = q._select_args()
+        prepare = self._prepare()
+        L = _merge(self._model._gather(lambda: db.select(sql, *args, row_type=db.Row, prepare=prepare)), order)
+        if sharded:
+            start = self._offset or 0
+            L = L[start:] if self._limit is None else L[start:start + self._limit]
+        return [self._model._from_row(d) for d in L]
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def iter(self, batch_size=100):
+        """逐行返回结果的generator，使用db.iter_select，分片的Model依次遍历每个分片，不做合并排序"""
+        sql = self._compile('select')
+        args = self._select_args()
+        for shard in self._model._shards():
+            for d in db.iter_select(sql, *args, batch_size=batch_size, row_type=db.Row, shard=shard):
+                yield self._model._from_row(d)
+
+    def first(self):
+        L = self.limit(1).all()
+        return L[0] if L else None
+
+    def count(self):
+        sql = self._compile('count')
+        prepare = self._prepare()
+        return sum(self._model._gather(lambda: db.select_int(sql, *self._args, prepare=prepare)))
+
+    def exists(self):
+        sql = self._compile('exists')
+        prepare = self._prepare()
+        return any([d is not None for d in self._model._gather(lambda: db.selectone(sql, *self._args, row_type=db.Row, prepare=prepare))])
+
+def _merge(parts, order):
+    """合并各分片的查询结果，多于一个分片时按order（(字段, 是否降序)的列表）排序"""
+    if len(parts) == 1:
+        return parts[0]
+    L = [d for part in parts for d in part]
+    for col, desc in reversed(order):
+        L.sort(key=operator.itemgetter(col), reverse=desc)
+    return L
+
+_RE_LIMIT = re.compile(r'(?:^|\s)limit\s+(\d+|\?)\s*$', re.IGNORECASE)
+_RE_OFFSET = re.compile(r'(?:^|\s)(?:limit|offset)\s', re.IGNORECASE)
+_RE_ORDER_BY = re.compile(r'(?:^|\s)order\s+by\s+(.+)$', re.IGNORECASE | re.DOTALL)
+_RE_ORDER_ITEM = re.compile(r'^`?(\w+)`?(?:\s+(asc|desc))?$', re.IGNORECASE)
+
+def _parse_order_limit(where, args):
+    """
+    解析where语句结尾的 order by 和 limit，用于合并各分片的结果
+    返回 ([(字段, 是否降序)], limit)，没有limit时为None
+    """
+    limit = None
+    m = _RE_LIMIT.search(where)
+    if m:
+        limit = int(args[-1] if m.group(1) == '?' else m.group(1))
+        where = where[:m.start()]
+    elif _RE_OFFSET.search(where):
+        raise ValueError('cannot merge shards for "%s": only "limit n" is supported, use page() or query()' % where)
+    order = []
+    m = _RE_ORDER_BY.search(where)
+    if m:
+        for item in m.group(1).split(','):
+            im = _RE_ORDER_ITEM.match(item.strip())
+            if im is None:
+                raise ValueError('cannot merge shards by "%s": only fields can be ordered by' % item.strip())
+            order.append((im.group(1), (im.group(2) or '').lower() == 'desc'))
+    return order, limit
+
+def _with_order(columns, order):
+    """投影查询时加上排序字段，合并分片的结果时需要按这些字段排序"""
+    if columns is None or not order:
+        return columns
+    return tuple(columns) + tuple([col for col, desc in order if col not in columns])
+
+def _encode_cursor(value, pk):
+    """把最后一行的排序值和主键编码为不透明的游标"""
+    return base64.urlsafe_b64encode(json.dumps([value, pk]))
+
+def _decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid page cursor: %s' % cursor)
+    return value, pk
+
+def prefetch(instances, field, model, attr=None):
+    """
+    批量加载关联对象，避免对每个实例单独调用model.get
+    field: instances中保存关联主键的字段，如'user_id'
+    model: 关联的Model类，如User
+    attr: 关联对象保存到的属性名，缺省为去掉'_id'后缀的field，如'user'
+    prefetch(blogs, 'user_id', User)  ==>  blog.user
+    只执行一次 model.get_many，找不到的关联对象为None
+    """
+    if attr is None:
+        attr = field[:-3] if field.endswith('_id') else '%s_obj' % field
+    instances = list(instances)
+    related = model.get_many([getattr(inst, field) for inst in instances])
+    for inst in instances:
+        setattr(inst, attr, related.get(getattr(inst, field)))
+    return instances
+
        
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -1,7 +1,8 @@
 #!/usr/bin/env_python
 # -*- coding: utf-8 -*-
 
-import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, traceback, urllib
+import types, os, re, cgi, sys, stat, time, datetime, functools, mimetypes, threading, logging, traceback, urllib, urlparse, tempfile, json, itertools, zlib, email.utils
+import db
 from db import Dict
 
 try:
@@ -10,6 +11,28 @@ except ImportError:
     from StringIO import StringIO
 
 
+def _to_str(s):
+	"""转换为str，unicode用utf-8编码"""
+	if isinstance(s, str):
+		return s
+	if isinstance(s, unicode):
+		return s.encode('utf-8')
+	return str(s)
+
+def _to_unicode(s, encoding='utf-8'):
+	"""str用encoding解码为unicode"""
+	if isinstance(s, unicode):
+		return s
+	return s.decode(encoding)
+
+def _quote(s, encoding='utf-8'):
+	if isinstance(s, unicode):
+		s = s.encode(encoding)
+	return urllib.quote(s)
+
+def _unquote(s, encoding='utf-8'):
+	return urllib.unquote(s).decode(encoding)
+
 ctx = threading.local()
 
 #正则表达式判断是否是正确的status code字符串
@@ -193,6 +216,10 @@ class HttpError(object):
 	@staticmethod
 	def conflict():
 		return _HttpError(409)
+
+	@staticmethod
+	def entitytoolarge():
+		return _HttpError(413)
 	@staticmethod
 	def redirect(location):
 		return _RedirectError(location)
@@ -202,32 +229,254 @@ class HttpError(object):
 """
 _RESPONSE_HEADER_DICT = dict(zip(map(lambda x : x.upper(), _RESPONSE_HEADERS),_RESPONSE_HEADERS))
 		
+#请求body的缺省上限
+_MAX_BODY_SIZE = 10 * 1024 * 1024
+#multipart中普通字段的值、每行header的长度上限
+_MAX_FIELD_SIZE = 1024 * 1024
+_MAX_HEADER_LINE = 16 * 1024
+#从wsgi.input每次读取的字节数，也是解析multipart时缓冲区的大小
+_READ_SIZE = 64 * 1024
+#input()中上传的文件超过该大小时才写入临时文件
+_SPOOL_SIZE = 1024 * 1024
+
+class _BodyReader(object):
+	"""
+	从wsgi.input读取最多CONTENT_LENGTH字节，超过max_size时抛出413
+	没有CONTENT_LENGTH时body为空，除非服务器设置了wsgi.input_terminated（此时读到结束为止）
+	"""
+	def __init__(self, environ, max_size):
+		self._fp = environ['wsgi.input']
+		self._max_size = max_size
+		self._size = 0
+		length = environ.get('CONTENT_LENGTH')
+		if not length and environ.get('wsgi.input_terminated'):
+			self._remaining = None
+			return
+		try:
+			self._remaining = int(length or 0)
+		except ValueError:
+			raise HttpError.badrequest()
+		if max_size is not None and self._remaining > max_size:
+			raise HttpError.entitytoolarge()
+
+	def read(self, size=-1):
+		if self._remaining is None:
+			data = self._fp.read(size) if size >= 0 else self._fp.read()
+			self._size += len(data)
+			if self._max_size is not None and self._size > self._max_size:
+				raise HttpError.entitytoolarge()
+			return data
+		if self._remaining <= 0:
+			return ''
+		if size < 0 or size > self._remaining:
+			size = self._remaining
+		data = self._fp.read(size)
+		if not data:
+			#客户端提前断开
+			self._remaining = 0
+			raise HttpError.badrequest()
+		self._remaining -= len(data)
+		return data
+
+class _MultipartStream(object):
+	"""
+	逐块解析multipart/form-data，缓冲区不超过 _READ_SIZE + 分隔符长度
+	parts()依次返回每个part的 (headers, 数据流)，取下一个part前未读完的数据会被跳过
+	"""
+	def __init__(self, fp, boundary):
+		self._fp = fp
+		self._delim = '\r\n--' + boundary
+		#在开头补上\r\n，第一个分隔符与其他分隔符的格式相同
+		self._buf = '\r\n'
+		self._eof = False
+		self._part_end = False
+
+	def _fill(self):
+		if self._eof:
+			raise HttpError.badrequest()
+		data = self._fp.read(_READ_SIZE)
+		if not data:
+			self._eof = True
+		self._buf += data
+
+	def _read_line(self):
+		while True:
+			i = self._buf.find('\r\n')
+			if i >= 0:
+				line = self._buf[:i]
+				self._buf = self._buf[i + 2:]
+				return line
+			if len(self._buf) > _MAX_HEADER_LINE:
+				raise HttpError.badrequest()
+			self._fill()
+
+	def read_part(self, size=-1):
+		"""读取当前part的最多size字节，遇到分隔符时返回空串"""
+		if self._part_end:
+			return ''
+		if size < 0:
+			size = _READ_SIZE
+		while True:
+			i = self._buf.find(self._delim)
+			if i == 0:
+				self._buf = self._buf[len(self._delim):]
+				self._part_end = True
+				return ''
+			#没有分隔符时，末尾可能是分隔符的前半部分，需要留在缓冲区
+			n = i if i > 0 else len(self._buf) - len(self._delim) + 1
+			if n > 0:
+				n = min(n, size)
+				data = self._buf[:n]
+				self._buf = self._buf[n:]
+				return data
+			self._fill()
+
+	def parts(self):
+		#跳过第一个分隔符之前的内容
+		while self.read_part():
+			pass
+		while True:
+			while len(self._buf) < 2:
+				self._fill()
+			if self._buf.startswith('--'):
+				return
+			self._read_line()
+			headers = {}
+			while True:
+				line = self._read_line()
+				if not line:
+					break
+				k, sep, v = line.partition(':')
+				if not sep:
+					raise HttpError.badrequest()
+				headers[k.strip().upper()] = v.strip()
+			self._part_end = False
+			yield headers, _PartStream(self)
+			while self.read_part():
+				pass
+
+class _PartStream(object):
+	"""multipart中一个part的数据，只能按顺序读取一次"""
+	def __init__(self, stream):
+		self._stream = stream
+
+	def read(self, size=-1):
+		"""读取size字节，size为负数时读到part结束，返回的数据不足size字节表示part已经结束"""
+		L = []
+		while size != 0:
+			data = self._stream.read_part(size)
+			if not data:
+				break
+			L.append(data)
+			if size > 0:
+				size -= len(data)
+		return ''.join(L)
+
+	def __iter__(self):
+		while True:
+			data = self._stream.read_part()
+			if not data:
+				return
+			yield data
+
+def _add_input(inputs, key, value):
+	"""同名的多个值保存为list"""
+	if key in inputs:
+		old = inputs[key]
+		if isinstance(old, list):
+			old.append(value)
+		else:
+			inputs[key] = [old, value]
+	else:
+		inputs[key] = value
+
 class Request(object):
 	"""request对象,获取所有的http请求信息"""
 
-	def __init__(self, environ):
+	def __init__(self, environ, max_body_size=_MAX_BODY_SIZE):
 		"""
 		该environ包含了用户发出的所有信息
+		max_body_size: body的字节数上限，超过时读取body抛出413，None表示不限制
 		"""
 		self._environ = environ
+		self._max_body_size = max_body_size
+		self._body_read = False
+
+	def _body_reader(self):
+		"""body只能读取一次"""
+		if self._body_read:
+			raise ValueError('request body has already been read')
+		self._body_read = True
+		return _BodyReader(self._environ, self._max_body_size)
+
+	def _get_query(self):
+		"""解析query string，不读取body"""
+		if not hasattr(self, '_query'):
+			query = {}
+			for k, v in urlparse.parse_qsl(self.query_string, keep_blank_values = True):
+				_add_input(query, k, _to_unicode(v))
+			self._query = query
+		return self._query
+
+	def _form_type(self):
+		"""返回body的类型：'urlencoded', 'multipart' 或 None（不是表单）"""
+		ctype, params = cgi.parse_header(self._environ.get('CONTENT_TYPE', ''))
+		#与cgi.FieldStorage相同，没有CONTENT_TYPE的POST按urlencoded处理
+		if ctype == 'application/x-www-form-urlencoded' or (not ctype and self.request_method == 'POST'):
+			return 'urlencoded', params
+		if ctype == 'multipart/form-data' and params.get('boundary'):
+			return 'multipart', params
+		return None, params
+
+	def stream_input(self):
+		"""
+		按顺序返回body中表单字段的generator：(name, value)
+		普通字段的value为unicode，上传的文件为MultiPartFile，其file直接从wsgi.input读取，
+		需要在取下一个字段之前读完，整个body不会载入内存
+		读取过body后，input()等只包含query string中的参数
+		for name, value in ctx.request.stream_input():
+			if isinstance(value, MultiPartFile):
+				for chunk in value.file:
+					...
+		"""
+		form_type, params = self._form_type()
+		if form_type == 'urlencoded':
+			for k, v in urlparse.parse_qsl(self._body_reader().read(), keep_blank_values = True):
+				yield k, _to_unicode(v)
+		elif form_type == 'multipart':
+			for headers, data in _MultipartStream(self._body_reader(), params['boundary']).parts():
+				disposition, dparams = cgi.parse_header(headers.get('CONTENT-DISPOSITION', ''))
+				name = dparams.get('name')
+				if name is None:
+					continue
+				if 'filename' in dparams:
+					yield name, MultiPartFile(dparams['filename'], data, headers.get('CONTENT-TYPE'))
+				else:
+					value = data.read(_MAX_FIELD_SIZE + 1)
+					if len(value) > _MAX_FIELD_SIZE:
+						raise HttpError.entitytoolarge()
+					yield name, _to_unicode(value)
 
 	def _parse_input(self):
 		"""
-		将environ中的参数解析成一个字典对象
-		 将通过wsgi 传入过来的参数，解析成一个字典对象 返回
+		将query string和body中的参数解析成一个字典对象，同名的多个值为list
+		body只在是表单时读取，上传的文件超过_SPOOL_SIZE时写入临时文件
         比如： Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
             这里解析的就是 wsgi.input 对象里面的字节流
 		"""
-		def _convert(item):
-			if isinstance(item, list):
-				return [utils.to_unicode(i.value) for i in item]
-			if item.filename:
-				return MultiPartFile(item)
-			return utils.to_unicode(item)
-		fs = cgi.FieldStorage(fp = self._environ['wsgi.input'], environ = self._environ, keep_blank_values = True)
 		inputs = dict()
-		for key in fs:
-			inputs[key] = _convert(fs[key])
+		for k, v in self._get_query().iteritems():
+			inputs[k] = v[:] if isinstance(v, list) else v
+		if self._body_read:
+			return inputs
+		for k, v in self.stream_input():
+			if isinstance(v, MultiPartFile):
+				f = tempfile.SpooledTemporaryFile(max_size = _SPOOL_SIZE)
+				for chunk in v.file:
+					f.write(chunk)
+				f.seek(0)
+				v = MultiPartFile(v.filename, f, v.content_type)
+			_add_input(inputs, k, v)
 		return inputs
 
 	def _get_raw_input(self):
@@ -282,7 +531,7 @@ class Request(object):
         i = ctx.request.input(role='guest')
         i.role ==> 'guest'
         >>> from StringIO import StringIO
-        >>> r = Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_LENGTH':'26', 'wsgi.input':StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
         >>> i = r.input(x=2008)
         >>> i.a
         u'1'
@@ -304,10 +553,25 @@ class Request(object):
 			copy[k] = v[0] if isinstance(v,list) else v
 		return copy
 
+	def query(self, **kw):
+		"""与input()相同，但只包含query string中的参数，不会读取body"""
+		copy = Dict(**kw)
+		for k,v in self._get_query().iteritems():
+			copy[k] = v[0] if isinstance(v,list) else v
+		return copy
+
 	def get_body(self):
-		"""从POST中取出body的值，返回一个str"""
-		fp = self._environ['wsgi.input']
-		return fp.read()
+		"""从POST中取出body的值，返回一个str，超过max_body_size时抛出413"""
+		return self._body_reader().read()
+
+	def iter_body(self, chunk_size=_READ_SIZE):
+		"""逐块返回body的generator，不把整个body载入内存"""
+		fp = self._body_reader()
+		while True:
+			data = fp.read(chunk_size)
+			if not data:
+				return
+			yield data
 
 	@property
 	def environ(self):
@@ -354,7 +618,7 @@ class Request(object):
 		"""
 		获取某个特定的header值
 		"""
-		return sefl._get_headers().get(header.upper(), default)
+		return self._get_headers().get(header.upper(), default)
 
 
 	def cookie(self, name, default = None):
@@ -381,7 +645,7 @@ class Request(object):
 				for c in cookie_str.split(';'):
 					pos = c.find('=')
 					if pos > 0:
-						cookies[c[:pos].strip()] = utils.unquote[c[pos+1:]]
+						cookies[c[:pos].strip()] = _unquote(c[pos+1:])
 			self._cookies = cookies
 		return self._cookies
 	
@@ -398,7 +662,7 @@ class Response(object):
 		key = name.upper()
 		if key not in _RESPONSE_HEADER_DICT:
 			key = name
-		self._headers[key] = utils.to_str(value)
+		self._headers[key] = _to_str(value)
 
 
 	def unset_header(self, name):
@@ -446,12 +710,12 @@ class Response(object):
 	#content_length
 	@property
 	def content_length(self):
-		return self.header('COTENT-LENGTH')
+		return self.header('CONTENT-LENGTH')
 
 	@content_length.setter
-	def cotent_length(self, value):
-		if value:
-			self.set_header('COTENT-LENGTH', str(value))
+	def content_length(self, value):
+		if value is not None:
+			self.set_header('CONTENT-LENGTH', str(value))
 		else :
 			self.unset_header('CONTENT-LENGTH')
 
@@ -469,7 +733,7 @@ class Response(object):
 		"""
 		if not hasattr(self, '_cookies'):
 			self._cookies = {}
-		L = ['%s = %s' %(utils.quote(name),util.quote(value))]
+		L = ['%s = %s' %(_quote(name),_quote(value))]
 		if expires is not None:
 			if isinstance(expires, (int, float, long)):
 				L.append('Expires=%s' %datetime.datetime.fromtimestamp(expires,UTC_0).strftime('%a, %d-%b-%Y %H:%M:%S GMT'))
@@ -596,20 +860,26 @@ def _build_regex(path):
 	re_list.append('$')
 	return ''.join(re_list)
 
-def _static_file_generator(fpath, block_size = 8192):
+def _static_file_generator(fpath, block_size = 8192, offset = 0, length = None):
 	"""
 	To master yield, 
 	you must understand that when you call the function, 
 	the code you have written in the function body does not run.
 	The function only returns the generator object, this is a bit tricky :-)
-	读取静态文件的一个generator
+	读取静态文件的一个generator，offset/length用于Range请求
 	"""
 
 	with open(fpath,'rb') as f:
-		block =  f.read(block_size)
-		while block:
+		if offset:
+			f.seek(offset)
+		remain = length
+		while remain is None or remain > 0:
+			block = f.read(block_size if remain is None else min(block_size, remain))
+			if not block:
+				break
+			if remain is not None:
+				remain -= len(block)
 			yield block
-			block = f.read(block_size) 
 
 class Route(object):
 	"""
@@ -658,31 +928,265 @@ class Route(object):
 
 	__repr__ = __str__
 
-class StaticFileRoute(object):
-	"""静态文件路有对象"""
+#整段都是变量的路径段，如 :id
+_re_route_segment = re.compile(r'^:[a-zA-Z_]\w*$')
+
+class _RouterNode(object):
+	"""前缀树的节点"""
 	def __init__(self):
+		#路径段 => 子节点
+		self.literals = {}
+		#整段是变量的子节点，所有路由共用，捕获的值按位置传给处理函数
+		self.param = None
+		#段内混合了变量和文字的 (段的正则, 子节点) 列表，如 :name.json
+		self.patterns = []
+		#在此结束的 (加入顺序, route)
+		self.route = None
+
+class _Router(object):
+	"""
+	动态路由的匹配，按 / 分段组织成前缀树，查找的代价与路由数量无关
+	多个路由都能匹配时返回最先加入的那个，与按顺序逐个match的结果相同
+	没有path的路由对象（如StaticFileRoute）不能分段，放在最后按顺序匹配
+	"""
+	def __init__(self, routes=()):
+		self._root = _RouterNode()
+		self._others = []
+		self._count = 0
+		for route in routes:
+			self.add(route)
+
+	def add(self, route):
+		index = self._count
+		self._count += 1
+		path = getattr(route, 'path', None)
+		if path is None:
+			self._others.append(route)
+			return
+		node = self._root
+		for seg in path.split('/'):
+			if _re_route_segment.match(seg):
+				if node.param is None:
+					node.param = _RouterNode()
+				node = node.param
+			elif _re_route.search(seg):
+				pattern = _build_regex(seg)
+				for regex, child in node.patterns:
+					if regex.pattern == pattern:
+						node = child
+						break
+				else:
+					child = _RouterNode()
+					node.patterns.append((re.compile(pattern), child))
+					node = child
+			else:
+				node = node.literals.setdefault(seg, _RouterNode())
+		if node.route is None:
+			node.route = (index, route)
+
+	def match(self, path):
+		"""返回 (route, 捕获的参数)，没有匹配的路由时返回 (None, None)"""
+		found = self._match(self._root, path.split('/'), 0, ())
+		if found:
+			return found[1], found[2]
+		for route in self._others:
+			args = route.match(path)
+			if args:
+				return route, args
+		return None, None
+
+	def _match(self, node, segs, i, args):
+		"""返回 (加入顺序, route, 参数) 中加入顺序最小的，没有时返回None"""
+		if i == len(segs):
+			if node.route is None:
+				return None
+			return node.route + (args,)
+		seg = segs[i]
+		best = None
+		child = node.literals.get(seg)
+		if child is not None:
+			best = self._match(child, segs, i + 1, args)
+		if seg and node.param is not None:
+			found = self._match(node.param, segs, i + 1, args + (seg,))
+			if found and (best is None or found[0] < best[0]):
+				best = found
+		for regex, child in node.patterns:
+			m = regex.match(seg)
+			if m:
+				found = self._match(child, segs, i + 1, args + m.groups())
+				if found and (best is None or found[0] < best[0]):
+					best = found
+		return best
+
+class _StaticFile(object):
+	"""缓存的静态文件信息，variants为预压缩的兄弟文件：编码 => _StaticFile"""
+	__slots__ = ('path', 'size', 'mtime', 'etag', 'last_modified', 'content_type', 'variants', 'checked')
+
+	def __init__(self, path, st, content_type=None):
+		self.path = path
+		self.size = st.st_size
+		self.mtime = int(st.st_mtime)
+		self.etag = '"%x-%x"' % (self.mtime, self.size)
+		self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+		self.content_type = content_type
+		self.variants = {}
+		self.checked = time.time()
+
+#预压缩文件的后缀，按优先顺序
+_STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+class StaticFileRoute(object):
+	"""
+	静态文件路由对象，处理 /static/ 下的文件
+	stat结果和Content-Type按路径缓存，超过stat_ttl秒后重新stat，文件修改后自动更新
+	存在 xxx.br / xxx.gz 且不旧于原文件时，按Accept-Encoding直接发送预压缩的文件
+	支持ETag/Last-Modified的条件请求（304）和单个范围的Range请求（206）
+	整个文件通过wsgi.file_wrapper发送，服务器支持时使用sendfile
+	"""
+	def __init__(self, max_age=3600, stat_ttl=5, block_size=65536):
 		self.method = 'GET'
 		self.is_static = False
 		self.route = re.compile('^/static/(.+)$')
+		self.max_age = max_age
+		self.stat_ttl = stat_ttl
+		self.block_size = block_size
+		#规范化后的文件路径 => _StaticFile，只缓存存在的文件，条目数不超过static目录下的文件数
+		self._files = {}
 
 	def match(self, url):
 		if url.startswith('/static/'):
 			return (url[1:],)
 		return None
 
+	def _lookup(self, document_root, rel):
+		"""返回rel对应的_StaticFile，文件不存在或不在static目录下时返回None"""
+		root = os.path.join(os.path.abspath(document_root or '.'), 'static')
+		fpath = os.path.normpath(os.path.join(root, rel[len('static/'):]))
+		if not fpath.startswith(root + os.sep):
+			return None
+		f = self._files.get(fpath)
+		if f is not None and time.time() - f.checked < self.stat_ttl:
+			return f
+		try:
+			st = os.stat(fpath)
+		except OSError:
+			self._files.pop(fpath, None)
+			return None
+		if not stat.S_ISREG(st.st_mode):
+			self._files.pop(fpath, None)
+			return None
+		fext = os.path.splitext(fpath)[1]
+		f = _StaticFile(fpath, st, mimetypes.types_map.get(fext.lower(), 'application/octet-stream'))
+		for encoding, suffix in _STATIC_ENCODINGS:
+			try:
+				vst = os.stat(fpath + suffix)
+			except OSError:
+				continue
+			if stat.S_ISREG(vst.st_mode) and int(vst.st_mtime) >= f.mtime:
+				f.variants[encoding] = _StaticFile(fpath + suffix, vst)
+		self._files[fpath] = f
+		return f
+
+	def _not_modified(self, environ, f):
+		"""If-None-Match优先，没有时再检查If-Modified-Since"""
+		if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+		if if_none_match:
+			for tag in if_none_match.split(','):
+				tag = tag.strip()
+				if tag.startswith('W/'):
+					tag = tag[2:]
+				if tag == '*' or tag == f.etag:
+					return True
+			return False
+		if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+		if if_modified_since:
+			t = email.utils.parsedate_tz(if_modified_since)
+			if t is not None and f.mtime <= email.utils.mktime_tz(t):
+				return True
+		return False
+
+	def _range(self, environ, f):
+		"""
+		返回Range请求的 (start, end)，end不包含在内
+		没有Range、If-Range不匹配或多个范围时返回None，发送整个文件；范围不能满足时返回False
+		"""
+		value = environ.get('HTTP_RANGE')
+		if not value or not value.startswith('bytes='):
+			return None
+		if_range = environ.get('HTTP_IF_RANGE')
+		if if_range and if_range != f.etag and if_range != f.last_modified:
+			return None
+		spec = value[6:].strip()
+		if ',' in spec:
+			return None
+		first, sep, last = spec.partition('-')
+		try:
+			if first:
+				start = int(first)
+				end = min(int(last) + 1, f.size) if last else f.size
+			else:
+				n = int(last)
+				if n <= 0:
+					return False
+				start, end = max(0, f.size - n), f.size
+		except ValueError:
+			return None
+		if start >= f.size or start >= end:
+			return False
+		return start, end
+
 	def __call__(self, *args):
-		fpath = os.path.join(ctx.application.document_root,args[0])
-		if not os.path.isfile(fpath):
+		request, response = ctx.request, ctx.response
+		environ = request.environ
+		f = self._lookup(ctx.application.document_root, args[0])
+		if f is None:
 			raise HttpError.notfound()
-		fext = os.path.splittext(fpath)[1]
-		ctx.response.content_type = mimetypes.types_map.get(fext.lower(),'application/octet-stream')
-		return _static_file_generator(fpath)
+		response.content_type = f.content_type
+		response.set_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+		response.set_header('Accept-Ranges', 'bytes')
+		if f.variants:
+			response.set_header('Vary', 'Accept-Encoding')
+			weights = _parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+			for encoding, suffix in _STATIC_ENCODINGS:
+				variant = f.variants.get(encoding)
+				if variant is not None and weights.get(encoding, weights.get('*', 0.0)) > 0:
+					response.set_header('Content-Encoding', encoding)
+					f = variant
+					break
+		response.set_header('ETag', f.etag)
+		response.set_header('Last-Modified', f.last_modified)
+		if self._not_modified(environ, f):
+			response.status = 304
+			return []
+		r = self._range(environ, f)
+		if r is False:
+			response.status = 416
+			response.set_header('Content-Range', 'bytes */%d' % f.size)
+			response.content_length = 0
+			return []
+		if r is None:
+			response.content_length = f.size
+			file_wrapper = environ.get('wsgi.file_wrapper')
+			if file_wrapper is not None:
+				return file_wrapper(open(f.path, 'rb'), self.block_size)
+			return _static_file_generator(f.path, self.block_size)
+		start, end = r
+		response.status = 206
+		response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, f.size))
+		response.content_length = end - start
+		return _static_file_generator(f.path, self.block_size, start, end - start)
 
 class MultiPartFile(object):
-	"""docstring for MultiPartFile"""
-	def __init__(self, storage):
-		self.filename = utils.to_unicode(storage.filename)
-		self.file = storage.file
+	"""
+	上传的文件
+	filename: 客户端的文件名
+	file: 文件内容的流，stream_input()中直接读取请求，input()中为内存或临时文件
+	content_type: 客户端给出的类型
+	"""
+	def __init__(self, filename, file, content_type=None):
+		self.filename = _to_unicode(filename)
+		self.file = file
+		self.content_type = content_type
 		
 		
 
@@ -699,6 +1203,86 @@ class Template(object):
 		self.template_name = template_name
 		self.model = dict(**kw)
 
+def _default_json_dumps(obj):
+	return json.dumps(obj, separators=(',', ':'))
+
+#JSON序列化函数，接受dict/list等，返回str或unicode
+_json_dumps = _default_json_dumps
+
+def set_json_encoder(dumps=None):
+	"""
+	设置JsonResponse使用的序列化函数，如 web.set_json_encoder(ujson.dumps)
+	传入None恢复缺省的json.dumps
+	"""
+	global _json_dumps
+	_json_dumps = dumps or _default_json_dumps
+
+def _jsonable(obj):
+	"""
+	把obj中任意层的db.Row转换成dict：Row是tuple，json会把它序列化成列名的数组
+	Model和Dict本身就是dict，值中没有dict/list/tuple时原样返回
+	"""
+	if isinstance(obj, db.Row):
+		obj = obj.to_dict()
+	if isinstance(obj, dict):
+		for v in obj.itervalues():
+			if isinstance(v, (dict, list, tuple)):
+				return dict([(k, _jsonable(v)) for k, v in obj.iteritems()])
+		return obj
+	if isinstance(obj, (list, tuple)):
+		return [_jsonable(x) for x in obj]
+	return obj
+
+class JsonResponse(object):
+	"""
+	JSON响应
+	obj: dict、Model、Dict、Row，或者由它们组成的list/tuple/generator（如Model.iter_all()）
+	status: 响应的状态码，None时不修改
+	单个对象和不超过chunk_size个元素的list一次序列化，并设置Content-Length
+	更长的list和generator每chunk_size个元素序列化一次，逐块输出JSON数组，不会生成整个列表
+	"""
+	def __init__(self, obj, status=None, chunk_size=500):
+		self.obj = obj
+		self.status = status
+		self.chunk_size = chunk_size
+
+	def apply(self, response):
+		"""设置response的header，返回WSGI的body"""
+		response.content_type = 'application/json; charset=utf-8'
+		if self.status is not None:
+			response.status = self.status
+		obj = self.obj
+		if isinstance(obj, (list, tuple)) and not isinstance(obj, db.Row):
+			if len(obj) > self.chunk_size:
+				return self._chunks(iter(obj))
+			body = _to_str(_json_dumps([_jsonable(x) for x in obj]))
+		elif obj is None or isinstance(obj, (dict, db.Row, basestring, int, long, float)):
+			body = _to_str(_json_dumps(_jsonable(obj)))
+		else:
+			return self._chunks(iter(obj))
+		response.content_length = len(body)
+		return [body]
+
+	def _chunks(self, it):
+		try:
+			yield '['
+			sep = ''
+			while True:
+				batch = [_jsonable(x) for x in itertools.islice(it, self.chunk_size)]
+				if not batch:
+					break
+				#去掉每批数组两边的括号，拼接成一个数组
+				yield sep + _to_str(_json_dumps(batch))[1:-1]
+				sep = ','
+			yield ']'
+		finally:
+			close = getattr(it, 'close', None)
+			if close:
+				close()
+
+def _to_json_response(r):
+	return r if isinstance(r, JsonResponse) else JsonResponse(r)
+
 #定义模板引擎
 class TemplateEngine(object):
 	"""模板引擎基类"""
@@ -749,18 +1333,33 @@ def view(path):
 	被装饰的func返回一个字典对象，用于渲染
 	装饰器通过Template类  将path和dict关联到Template对象上
 	"""
+	def _template(r):
+		if isinstance(r, dict):
+			logging.info('return Template')
+			return Template(path, **r)
+		raise ValueError('expect return a dict')
+
 	def _decorator(func):
 		@functools.wraps(func)
 		def _wrapper(*args, **kw):
-			r = func(*args, **kw)
-			if isinstance(r, dict):
-				logging.info('return Template')
-				return Template(path, **r)
-			else:
-				raise ValueError('expect return a dict')
+			return _template(func(*args, **kw))
 		return _wrapper
 	return _decorator
 
+def api(func):
+	"""
+	装饰器
+	把func的返回值包装为JsonResponse，返回generator时以流的方式输出JSON数组
+	@api
+	@get('/api/blogs')
+	def api_blogs():
+		return Blog.iter_all()
+	"""
+	@functools.wraps(func)
+	def _wrapper(*args, **kw):
+		return _to_json_response(func(*args, **kw))
+	return _wrapper
+
 ##################
 #实现URL拦截
 #主要是interceptor的实现
@@ -772,10 +1371,10 @@ def _build_pattern_fn(pattern):
 	返回一个函数
 	该函数接受一个字符串，检测该字符串是否符合pattern
 	"""
-	m = _RE_INTERCEPTOR_STARTS_WITH(pattern)
+	m = _RE_INTERCEPTOR_STARTS_WITH.match(pattern)
 	if m:
 		return lambda p : p.startswith(m.group(1))
-	m = _RE_INTERCEPTOR_ENDS_WITH(pattern)
+	m = _RE_INTERCEPTOR_ENDS_WITH.match(pattern)
 	if m:
 		return lambda p : p.endswith(m.group(1))
 	raise ValueError('Invalid pattern definition in interceptor.')
@@ -808,6 +1407,183 @@ def _build_interceptor_chain(last_fn, *interceptors):
 		fn = _build_interceptor_fn(f, fn)
 	return fn
 
+###############
+#响应压缩
+###############
+#缺省压缩的Content-Type，图片等已经压缩过的类型不再压缩
+_COMPRESS_TYPES = frozenset([
+	'text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript', 'text/csv',
+	'application/javascript', 'application/x-javascript', 'application/json', 'application/xml',
+	'image/svg+xml',
+])
+
+#Content-Encoding => zlib的wbits，gzip需要16 + MAX_WBITS，HTTP的deflate是zlib格式
+_COMPRESS_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+def _parse_accept_encoding(accept_encoding):
+	"""解析Accept-Encoding，返回 编码 => q值"""
+	weights = {}
+	for part in (accept_encoding or '').split(','):
+		name, sep, params = part.partition(';')
+		name = name.strip().lower()
+		if not name:
+			continue
+		weight = 1.0
+		params = params.strip().replace(' ', '')
+		if params.startswith('q='):
+			try:
+				weight = float(params[2:])
+			except ValueError:
+				weight = 0.0
+		weights[name] = weight
+	return weights
+
+class Compressor(object):
+	"""
+	按请求的Accept-Encoding用gzip或deflate压缩响应
+	min_size: 长度已知且小于该字节数时不压缩
+	mime_types: 需要压缩的Content-Type
+	level: zlib的压缩级别，1最快，9压缩率最高
+	长度已知的响应（list）一次压缩并设置Content-Length，generator等逐块压缩
+	"""
+	def __init__(self, min_size=1024, mime_types=_COMPRESS_TYPES, level=6):
+		self.min_size = min_size
+		self.mime_types = frozenset(mime_types)
+		self.level = level
+
+	def choose(self, accept_encoding):
+		"""返回客户端接受的编码，q值相同时优先gzip，都不接受时返回None"""
+		weights = _parse_accept_encoding(accept_encoding)
+		best, best_weight = None, 0.0
+		for encoding in ('gzip', 'deflate'):
+			weight = weights.get(encoding, weights.get('*', 0.0))
+			if weight > best_weight:
+				best, best_weight = encoding, weight
+		return best
+
+	def apply(self, accept_encoding, status, headers, body):
+		"""返回压缩后的 (headers, body)，不需要压缩时原样返回"""
+		code = int(status[:3])
+		if code < 200 or code in (204, 206, 304):
+			return headers, body
+		hdrs = dict([(k.upper(), v) for k, v in headers])
+		if 'CONTENT-ENCODING' in hdrs or 'CONTENT-RANGE' in hdrs:
+			return headers, body
+		if hdrs.get('CONTENT-TYPE', '').split(';')[0].strip().lower() not in self.mime_types:
+			return headers, body
+		known = isinstance(body, (list, tuple))
+		if known:
+			size = sum([len(x) for x in body])
+		else:
+			try:
+				size = int(hdrs['CONTENT-LENGTH'])
+			except (KeyError, ValueError):
+				size = None
+		if size is not None and size < self.min_size:
+			return headers, body
+		encoding = self.choose(accept_encoding)
+		if encoding is None:
+			return headers, body
+		L = []
+		vary = False
+		for k, v in headers:
+			key = k.upper()
+			if key == 'CONTENT-LENGTH':
+				continue
+			if key == 'ETAG' and not v.startswith('W/'):
+				#压缩后的内容与原内容不同，改为弱ETag
+				v = 'W/' + v
+			if key == 'VARY':
+				vary = True
+				if 'accept-encoding' not in v.lower():
+					v = v + ', Accept-Encoding'
+			L.append((k, v))
+		if not vary:
+			L.append(('Vary', 'Accept-Encoding'))
+		L.append(('Content-Encoding', encoding))
+		if known:
+			c = zlib.compressobj(self.level, zlib.DEFLATED, _COMPRESS_WBITS[encoding])
+			data = c.compress(''.join([_to_str(x) for x in body])) + c.flush()
+			L.append(('Content-Length', str(len(data))))
+			return L, [data]
+		return L, self._stream(body, encoding)
+
+	def _stream(self, body, encoding):
+		c = zlib.compressobj(self.level, zlib.DEFLATED, _COMPRESS_WBITS[encoding])
+		try:
+			for chunk in body:
+				data = c.compress(_to_str(chunk))
+				if data:
+					yield data
+			yield c.flush()
+		finally:
+			close = getattr(body, 'close', None)
+			if close:
+				close()
+
+class CompressMiddleware(object):
+	"""
+	压缩响应的WSGI中间件，参数与Compressor相同，可以包装任何WSGI application
+	application = CompressMiddleware(wsgi.get_wsgi_application(), min_size=1024, level=6)
+	application可以在返回的iterable第一次迭代时才调用start_response（PEP 3333），
+	通过start_response返回的write写出的数据先缓存，放在body之前一起压缩
+	"""
+	def __init__(self, app, **kw):
+		self._app = app
+		self._compressor = kw.pop('compressor', None) or Compressor(**kw)
+
+	def __call__(self, env, start_response):
+		captured = []
+		written = []
+		sent = []
+		def _start_response(status, headers, exc_info=None):
+			if sent:
+				#header已经发出，交给服务器处理（会重新抛出exc_info）
+				return start_response(status, headers, exc_info)
+			captured[:] = [status, headers, exc_info]
+			return written.append
+		body = self._app(env, _start_response)
+		head = []
+		if not captured:
+			#推迟调用start_response的application，迭代到调用为止
+			it = iter(body)
+			try:
+				while not captured:
+					head.append(next(it))
+			except StopIteration:
+				pass
+			except:
+				_close_body(body)
+				raise
+			if not captured:
+				_close_body(body)
+				raise RuntimeError('start_response was not called by %r' % self._app)
+			body = self._drain(written, head, it, body)
+		elif written:
+			body = written + list(body) if isinstance(body, (list, tuple)) else self._drain(written, [], iter(body), body)
+		status, headers, exc_info = captured
+		headers, body = self._compressor.apply(env.get('HTTP_ACCEPT_ENCODING'), status, headers, body)
+		sent.append(True)
+		start_response(status, headers, exc_info)
+		return body
+
+	def _drain(self, written, head, it, body):
+		"""依次产生write写出的数据和body的数据，结束时关闭原来的body"""
+		try:
+			for chunk in itertools.chain(head, it):
+				while written:
+					yield written.pop(0)
+				yield chunk
+			while written:
+				yield written.pop(0)
+		finally:
+			_close_body(body)
+
+def _close_body(body):
+	close = getattr(body, 'close', None)
+	if close:
+		close()
+
 def _load_module(module_name):
 	"""load module from name as str"""
 	last_dot = module_name.rfind('.')
@@ -828,6 +1604,27 @@ class WSGIApplication(object):
 		"""
 		self._running = False
 		self._document_root = document_root
+		#为每个请求打开一个惰性的数据库连接上下文，请求内所有db调用共用一个连接
+		self._db_per_request = kw.get('db_per_request', False)
+		#在请求的连接上下文中开启identity map，需要同时开启db_per_request
+		self._db_identity_map = kw.get('db_identity_map', False)
+		#请求body的字节数上限，None表示不限制
+		self._max_body_size = kw.get('max_body_size', _MAX_BODY_SIZE)
+		#响应压缩：True使用缺省的Compressor，也可以传入Compressor的参数dict或Compressor对象
+		compress = kw.get('compress')
+		if compress is True:
+			compress = Compressor()
+		elif isinstance(compress, dict):
+			compress = Compressor(**compress)
+		self._compressor = compress or None
+		#静态文件：True使用缺省的StaticFileRoute，也可以传入StaticFileRoute的参数dict，
+		#缺省为None，只在debug模式下处理 /static/
+		static = kw.get('static')
+		if static is True:
+			static = StaticFileRoute()
+		elif isinstance(static, dict):
+			static = StaticFileRoute(**static)
+		self._static_route = static or None
 
 		self._interceptors = []
 		self._template_engine = None
@@ -838,6 +1635,10 @@ class WSGIApplication(object):
 		self._get_dynamic = []
 		self._post_dynamic = []
 
+		self._statics = {'GET': self._get_static, 'POST': self._post_static}
+		#请求方法 => _Router，开始运行时由动态路由列表构建
+		self._routers = {}
+
 
 	def _check_not_running(self):
 		"""检查app对象是否运行"""
@@ -875,7 +1676,7 @@ class WSGIApplication(object):
 			if route.method == 'GET':
 				self._get_dynamic.append(route)
 			if route.method == 'POST':
-				route._post_dynamic.append(route)
+				self._post_dynamic.append(route)
 
 		logging.info('add route: %s' %str(route))
 
@@ -895,82 +1696,93 @@ class WSGIApplication(object):
 		server = make_server(host,port, self.get_wsgi_application(debug=True))
 		server.serve_forever()
 
-	def get_wsgi_application(self, debug=False):
+	def _find_route(self, request_method, path_info):
+		"""返回 (route, 捕获的参数)，找不到时抛出404"""
+		static = self._statics.get(request_method)
+		if static is None:
+			raise HttpError.badrequest()
+		fn = static.get(path_info, None)
+		if fn:
+			return fn, ()
+		fn, args = self._routers[request_method].match(path_info)
+		if fn is None:
+			raise HttpError.notfound()
+		return fn, args
+
+	def _prepare(self, debug):
+		"""冻结路由表和拦截器，返回ctx.application"""
 		self._check_not_running()
-		if debug:
+		if self._static_route:
+			self._get_dynamic.append(self._static_route)
+		elif debug:
 			self._get_dynamic.append(StaticFileRoute())
+		self._routers = {'GET': _Router(self._get_dynamic), 'POST': _Router(self._post_dynamic)}
 		self._running = True
+		return Dict(document_root= self._document_root)
+
+	def _error_response(self, e, debug):
+		"""在except块中调用，返回异常对应的 (status, headers, body)"""
+		response = ctx.response
+		if isinstance(e, _RedirectError):
+			response.set_header('Location', e.location)
+			return e.status, response.headers, []
+		if isinstance(e, _HttpError):
+			return e.status, response.headers, ['<html><body><h1>', e.status, '</h1></body></html>']
+		logging.exception(e)
+		if not debug:
+			return '500 Internal Server Error', [], ['<html><body><h1>500 Internal Server Error</h1></body></html>']
+		exc_type, exc_value, exc_traceback = sys.exc_info()
+		fp = StringIO()
+		traceback.print_exception(exc_type, exc_value, exc_traceback, file=fp)
+		stacks = fp.getvalue()
+		fp.close()
+		return '500 Internal Server Error', [], [
+		    r'''<html><body><h1>500 Internal Server Error</h1><div style="font-family:Monaco, Menlo, Consolas, 'Courier New', monospace;"><pre>''',
+		    stacks.replace('<', '&lt;').replace('>', '&gt;'),
+		    '</pre></div></body></html>']
 
-		_application = Dict(document_root= self._document_root)
+	def get_wsgi_application(self, debug=False):
+		_application = self._prepare(debug)
 
 		def fn_route():
-			request_method = ctx.request.request_method
-			path_info = ctx.request.path_info
-			if request_method == 'GET':
-				fn = self._get_static.get(path_info,None)
-				if fn:
-					return fn()
-				for fn in self._get_dynamic:
-					args = fn.match(path_info)
-					if args:
-						return fn(*args)
-				raise HttpError.notfound()
-			if request.method == 'POST':
-				fn = self._post_static.get(path_info,None)
-				if fn:
-					return fn()
-				for fn in self._post_dynamic:
-					args = fn.match(path_info)
-					if args:
-						return fn(*args)
-				raise HttpError.notfound()
-			raise badrequest()
+			fn, args = self._find_route(ctx.request.request_method, ctx.request.path_info)
+			return fn(*args)
 
 		fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
 
 		def wsgi(env, start_response):
 			ctx.application = _application
-			ctx.request = Request(env)
+			ctx.request = Request(env, self._max_body_size)
 			response = ctx.response = Response()
+			db_ctx = db.connection(self._db_identity_map) if self._db_per_request else None
+			if db_ctx:
+				db_ctx.__enter__()
 			try:
 				r = fn_exec()
-				print r
 				if isinstance(r, Template):
 					r = self._template_engine(r.template_name, r.model)
+				if isinstance(r, JsonResponse):
+					r = r.apply(response)
 				if isinstance(r, unicode):
 					r = r.encode('utf-8')
-				if isinstance(r, Template):
-					r = self._template_engine(r.template_name, r.model)
 				if r is None:
 					r = []
+				elif isinstance(r, str):
+					#直接返回str时服务器会逐个字符写出
+					r = [r]
 				start_response(response.status, response.headers)
-				print response.headers
 				return r
-			except _RedirectError, e:
-				response.set_header('Location', e.location)
-				start_response(e.status, response.headers)
-				return []
-			except _HttpError, e:
-				start_response(e.status, response.headers)
-				return ['<html><body><h1>', e.status, '</h1></body></html>']
-			except Exception, e:
-				logging.exception(e)
-				if not debug:
-					start_response('500 Internal Server Error', [])
-					return ['<html><body><h1>500 Internal Server Error</h1></body></html>']
-				exc_type, exc_value, exc_traceback = sys.exc_info()
-				fp = StringIO()
-				traceback.print_exception(exc_type, exc_value, exc_traceback, file=fp)
-				stacks = fp.getvalue()
-				fp.close()
-				start_response('500 Internal Server Error', [])
-				return [
-				    r'''<html><body><h1>500 Internal Server Error</h1><div style="font-family:Monaco, Menlo, Consolas, 'Courier New', monospace;"><pre>''',
-				    stacks.replace('<', '&lt;').replace('>', '&gt;'),
-				    '</pre></div></body></html>']
+			except Exception as e:
+				status, headers, body = self._error_response(e, debug)
+				start_response(status, headers)
+				return body
 			finally:
+				if db_ctx:
+					db_ctx.__exit__(None, None, None)
 				del ctx.application
 				del ctx.request
 				del ctx.response
 
-		return wsgi
\ No newline at end of file
+		if self._compressor:
+			return CompressMiddleware(wsgi, compressor=self._compressor)
+		return wsgi
@@ -15,7 +15,7 @@ logging.basicConfig(level = logging.DEBUG)
 db.create_engine(**configs.db)
 
 #init wsgi app
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), db_per_request=True, db_identity_map=True, compress=dict(min_size=1024, level=6), static=dict(max_age=86400))
 
 
 template_engine = Jinjia2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)),'templates'))